@@ -38,3 +38,47 @@ class DisjointSets(object):
         if p1 != p2:
             self.num_sets -= 1
             self.parents[p1] = p2
+
+
+class ArrayDisjointSets(object):
+    """Disjoint Sets over the elements 0, 1, ..., stored in lists indexed by element.
+
+    Implements iterative path compression and union by size, so it stays fast
+    and never recurses deeply on large numbers of elements.
+    """
+
+    def __init__(self, num_elements=0):
+        self.num_sets = num_elements
+        self.parents = list(range(num_elements))
+        self.sizes = [1] * num_elements
+
+    def is_connected(self):
+        return self.num_sets == 1
+
+    def get_num_elements(self):
+        return len(self.parents)
+
+    def add_singleton(self):
+        """Adds a new element in a set of its own and returns it."""
+        element = len(self.parents)
+        self.parents.append(element)
+        self.sizes.append(1)
+        self.num_sets += 1
+        return element
+
+    def find(self, element):
+        root = element
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[element] != root:
+            self.parents[element], element = root, self.parents[element]
+        return root
+
+    def union(self, e1, e2):
+        p1, p2 = self.find(e1), self.find(e2)
+        if p1 != p2:
+            if self.sizes[p1] > self.sizes[p2]:
+                p1, p2 = p2, p1
+            self.num_sets -= 1
+            self.parents[p1] = p2
+            self.sizes[p2] += self.sizes[p1]
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from gridworld import GridworldMdpWithDistanceFeatures
+
+# Increase when the way environments are generated changes, so that old caches aren't used
+CACHE_VERSION = 2
+
+# Arguments that change the generated reward spaces or environments
+ENV_ARGS = ['seed', 'mdp_type', 'feature_dim', 'size_true_space', 'size_proxy_space', 'proxy_space_is_true_space',
+            'well_spec', 'repeated_obj', 'num_obj_if_repeated', 'num_experiments', 'num_test_envs', 'height', 'width',
+            'dist_scale', 'linear_features', 'decorrelate_test_feat', 'noise', 'num_states', 'feature_block_size']
+
+
+def get_env_cache_path(cache_dir, args):
+    """Returns the directory in cache_dir for the environments generated with args, named by a hash of the
+    arguments that affect them."""
+    key = {name: getattr(args, name) for name in ENV_ARGS}
+    key['version'] = CACHE_VERSION
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, digest[:16])
+
+
+def save_envs(path, arrays):
+    """Saves the dictionary of arrays as one .npy file per array in the directory path, along with the current states
+    of random and np.random. Writes to a temporary directory first, so that processes that start at the same time
+    never see a partial cache. If another process saved first, its cache is kept."""
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = dict(arrays)
+    version, python_state, gauss_next = random.getstate()
+    arrays['python_random_state'] = np.array(python_state, dtype=np.int64)
+    arrays['python_random_gauss'] = np.array([version, np.nan if gauss_next is None else gauss_next])
+    _, numpy_state, pos, has_gauss, cached_gaussian = np.random.get_state()
+    arrays['numpy_random_state'] = numpy_state
+    arrays['numpy_random_gauss'] = np.array([pos, has_gauss, cached_gaussian])
+
+    temp_path = tempfile.mkdtemp(dir=cache_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, name + '.npy'), array)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        shutil.rmtree(temp_path)
+
+
+def load_envs(path):
+    """Returns the dictionary of arrays saved in path, memory-mapped read-only, or None if there is no cache.
+
+    Call restore_random_states once everything that the generating run drew after saving is to be drawn again."""
+    if not os.path.isdir(path):
+        return None
+    return {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def restore_random_states(arrays):
+    """Sets random and np.random to the states they had when the arrays were saved."""
+    version, gauss_next = arrays['python_random_gauss']
+    python_state = tuple(int(x) for x in arrays['python_random_state'])
+    random.setstate((int(version), python_state, None if np.isnan(gauss_next) else gauss_next))
+    pos, has_gauss, cached_gaussian = arrays['numpy_random_gauss']
+    np.random.set_state(('MT19937', np.array(arrays['numpy_random_state']), int(pos), int(has_gauss),
+                         cached_gaussian))
+
+
+def get_shared_array(shared_dir, array, dtype=None):
+    """Returns a read-only memory-mapped copy of array, converted to dtype, from a file in shared_dir named by a hash
+    of its contents. Processes that share the same array map the same file, so the operating system keeps a single
+    copy of it in memory for all of them. The file is written if no process has written it yet."""
+    array = np.ascontiguousarray(array, dtype=dtype)
+    digest = hashlib.sha1(str((array.dtype.str, array.shape)).encode())
+    digest.update(array.data)
+    path = os.path.join(shared_dir, digest.hexdigest()[:16] + '.npy')
+    if not os.path.exists(path):
+        if not os.path.exists(shared_dir):
+            os.makedirs(shared_dir)
+        temp_file, temp_path = tempfile.mkstemp(dir=shared_dir, suffix='.npy')
+        with os.fdopen(temp_file, 'wb') as f:
+            np.save(f, array)
+        os.chmod(temp_path, 0o644)
+        # The file is only ever replaced by one with the same contents
+        os.rename(temp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def gridworlds_to_arrays(mdps, prefix):
+    """Encodes GridworldMdpWithDistanceFeatures of the same size as arrays named prefix + '_walls' etc."""
+    num_goals = len(mdps[0].goals)
+    max_objects = max(len(obj_nums) for mdp in mdps for _, _, obj_nums in mdp.goals)
+    goals = np.zeros([len(mdps), num_goals, 2], dtype=np.int64)
+    goal_objects = np.full([len(mdps), num_goals, max_objects], -1, dtype=np.int64)
+    goal_rewards = np.zeros([len(mdps), num_goals], dtype=np.int64)
+    for n, mdp in enumerate(mdps):
+        assert len(mdp.goals) == num_goals
+        for g, (x, y, obj_nums) in enumerate(mdp.goals):
+            goals[n, g] = x, y
+            goal_objects[n, g, :len(obj_nums)] = obj_nums
+            goal_rewards[n, g] = mdp.grid[y][x]
+    return {
+        prefix + '_walls': np.array([mdp.walls for mdp in mdps], dtype=bool),
+        prefix + '_start_states': np.array([mdp.start_state for mdp in mdps], dtype=np.int64),
+        prefix + '_goals': goals,
+        prefix + '_goal_objects': goal_objects,
+        prefix + '_goal_rewards': goal_rewards,
+        prefix + '_feature_matrices': np.array([mdp.feature_matrix for mdp in mdps])
+    }
+
+
+def arrays_to_gridworlds(arrays, prefix, args, dist_scale, noise):
+    """Rebuilds the MDPs encoded by gridworlds_to_arrays. The feature matrices aren't recomputed, so they stay
+    memory-mapped."""
+    mdps = []
+    for n, walls in enumerate(arrays[prefix + '_walls']):
+        grid = [['X' if wall else ' ' for wall in row] for row in walls]
+        start_x, start_y = arrays[prefix + '_start_states'][n]
+        grid[start_y][start_x] = 'A'
+        goals = []
+        for (x, y), objects, reward in zip(arrays[prefix + '_goals'][n], arrays[prefix + '_goal_objects'][n],
+                                           arrays[prefix + '_goal_rewards'][n]):
+            x, y = int(x), int(y)
+            grid[y][x] = int(reward)
+            goals.append((x, y, [int(obj_num) for obj_num in objects if obj_num >= 0]))
+        mdps.append(GridworldMdpWithDistanceFeatures(grid, goals, args, dist_scale, living_reward=-0.01, noise=noise,
+                                                     feature_matrix=arrays[prefix + '_feature_matrices'][n]))
+    return mdps
@@ -0,0 +1,64 @@
+import argparse
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from env_cache import (arrays_to_gridworlds, get_env_cache_path, get_shared_array, gridworlds_to_arrays, load_envs,
+                       restore_random_states, save_envs)
+from gridworld import GridworldMdpWithDistanceFeatures
+
+
+class TestEnvCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(
+            seed=1, mdp_type='gridworld', feature_dim=4, size_true_space=10, size_proxy_space=5,
+            proxy_space_is_true_space=0, well_spec=1, repeated_obj=0, num_obj_if_repeated=50, num_experiments=1,
+            num_test_envs=3, height=8, width=9, dist_scale=0.5, linear_features=1, decorrelate_test_feat=1, noise=0,
+            num_states=100, feature_block_size=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_path_depends_on_env_args(self):
+        path = get_env_cache_path(self.cache_dir, self.args)
+        self.assertEqual(get_env_cache_path(self.cache_dir, self.args), path)
+        self.args.seed = 2
+        self.assertNotEqual(get_env_cache_path(self.cache_dir, self.args), path)
+
+    def test_save_and_load(self):
+        path = get_env_cache_path(self.cache_dir, self.args)
+        self.assertIsNone(load_envs(path))
+        mdps = GridworldMdpWithDistanceFeatures.generate_random_mdps(self.args, 3, 8, 9, 0.35, seed=5)
+        reward_space = np.random.randint(-9, 10, size=[10, 4])
+        arrays = gridworlds_to_arrays(mdps, 'test')
+        arrays['reward_space_true'] = reward_space
+        save_envs(path, arrays)
+        draws = np.random.random_sample(3), random.random()
+
+        np.random.seed(0)
+        loaded = load_envs(path)
+        restore_random_states(loaded)
+        self.assertEqual((list(np.random.random_sample(3)), random.random()), (list(draws[0]), draws[1]))
+        self.assertTrue(np.array_equal(loaded['reward_space_true'], reward_space))
+        for mdp, loaded_mdp in zip(mdps, arrays_to_gridworlds(loaded, 'test', self.args, 0.5, 0)):
+            self.assertEqual(loaded_mdp.grid, mdp.grid)
+            self.assertEqual(loaded_mdp.goals, mdp.goals)
+            self.assertEqual(loaded_mdp.start_state, mdp.start_state)
+            self.assertTrue(np.array_equal(loaded_mdp.feature_matrix, mdp.feature_matrix))
+
+    def test_shared_array(self):
+        reward_space = np.random.randint(-9, 10, size=[10, 4]).astype(np.int16)
+        shared = get_shared_array(self.cache_dir, reward_space, np.float32)
+        self.assertEqual(shared.dtype, np.float32)
+        self.assertTrue(np.array_equal(shared, reward_space))
+        self.assertFalse(shared.flags.writeable)
+        self.assertEqual(get_shared_array(self.cache_dir, reward_space, np.float32).filename, shared.filename)
+        self.assertNotEqual(get_shared_array(self.cache_dir, reward_space[1:], np.float32).filename, shared.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,17 @@
 # External Libs
+import math
+import multiprocessing
 import random
 from collections import defaultdict
+from functools import partial
 
 import numpy as np
+from scipy.ndimage import label
 from scipy.stats import invwishart, multivariate_normal
 
 # Internal Libs
-from disjoint_sets import DisjointSets
+from disjoint_sets import ArrayDisjointSets
+from tabular_mdp import TabularMdp
 
 
 ########################################################
@@ -77,6 +82,12 @@ class Mdp(object):
         """Encodes this MDP in a format well-suited for deep models."""
         raise NotImplemented
 
+    def convert_to_tabular_input(self):
+        """Encodes this MDP as integer-indexed arrays, see TabularMdp. The MDP is compiled once and then cached."""
+        if getattr(self, 'tabular_mdp', None) is None:
+            self.tabular_mdp = TabularMdp(self)
+        return self.tabular_mdp
+
 
 class NStateMdp(Mdp):
     '''An MDP with N=num_states states and N actions which are always possible.
@@ -240,6 +251,58 @@ class NStateMdpGaussianFeatures(NStateMdp):
         return self.feature_matrix
 
 
+class NStateMdpStreamedGaussianFeatures(NStateMdp):
+    """
+    Like NStateMdpGaussianFeatures, but the features are never stored. They are generated from the seed a block of
+    block_size states at a time, so memory doesn't grow with the number of states. Plan with StreamingBanditsModel.
+
+    Additional variables:
+    -num_states_reachable: Integer k <= N which we may change between training and test MDP.
+    -SEED
+    -block_size: Number of states whose features are generated together.
+    """
+
+    def __init__(self, num_states, rewards, start_state, preterminal_states, feature_dim, num_states_reachable, SEED=1,
+                 block_size=10000):
+        super(NStateMdpStreamedGaussianFeatures, self).__init__(num_states, rewards, start_state, preterminal_states)
+        self.SEED = SEED
+        self.feature_dim = feature_dim
+        self.num_states_reachable = num_states_reachable
+        self.block_size = block_size
+        self.type = 'bandits'
+
+    @staticmethod
+    def generate_feature_block(seed, block, block_size, num_states, feature_dim):
+        """Returns the features of the states in the given block, drawn from a standard Gaussian seeded by the MDP's
+        seed and the block. The last block may have fewer than block_size states."""
+        features = np.random.RandomState([seed, block]).standard_normal([block_size, feature_dim])
+        return features[:num_states - block * block_size].astype(np.float32)
+
+    def get_feature_block(self, block):
+        return self.generate_feature_block(self.SEED, block, self.block_size, self.num_states, self.feature_dim)
+
+    def get_features(self, state):
+        return self.get_feature_block(state // self.block_size)[state % self.block_size]
+
+    def get_actions(self, state):
+        """Returns available actions except ones that lead to unreachable states"""
+        actions = super(NStateMdpStreamedGaussianFeatures, self).get_actions(state)
+        if Direction.EXIT in actions:
+            return actions
+        return actions[:self.num_states_reachable]
+
+    def convert_to_numpy_input(self):
+        """Returns the features of all states. This takes memory proportional to the number of states, so only use it
+        for small MDPs."""
+        num_blocks = -(-self.num_states // self.block_size)
+        return np.concatenate([self.get_feature_block(block) for block in range(num_blocks)])
+
+    def convert_to_streamed_input(self):
+        """Returns what StreamingBanditsModel needs to generate the features: the seed, number of states and block
+        size."""
+        return self.SEED, self.num_states, self.block_size
+
+
 class NStateMdpRandomGaussianFeatures(NStateMdp):
     """
     Features for each state are drawn from a different Gaussian for each state. The map: state \mapsto features is stochastic.
@@ -338,8 +401,11 @@ class GridworldMdp(Mdp):
 
     @staticmethod
     def generate_random(args, height, width, pr_wall, feature_dim, goals=None, living_reward=0, noise=0,
-                        print_grid=False, decorrelate=False):
-        """Generates a random instance of a Gridworld."""
+                        print_grid=False, decorrelate=False, rng=None):
+        """Generates a random instance of a Gridworld.
+
+        Uses the global random states of random and np.random, unless rng (a np.random.Generator) is given."""
+        np_rng = np.random if rng is None else rng
 
         # Does each goal\object type appear multiple times?
         if args.repeated_obj:
@@ -348,7 +414,7 @@ class GridworldMdp(Mdp):
             num_goals = feature_dim
 
         def generate_goals(states):
-            goal_pos = np.random.choice(len(states), num_goals, replace=False)
+            goal_pos = np_rng.choice(len(states), num_goals, replace=False)
             # Place a 'proxy' goal/object which is in the same position as another goal everywher except once
             if args.repeated_obj:
                 placed_proxy = False
@@ -360,7 +426,7 @@ class GridworldMdp(Mdp):
                     if not decorrelate:
                         # For object number feature_dim-2, correlate it with object feature_dim with probability p_corr
                         # feature_dim-2 is the proxy
-                        obj_type_1 = np.random.choice(feature_dim - 1)
+                        obj_type_1 = np_rng.choice(feature_dim - 1)
                         if obj_type_1 == feature_dim - 2:
                             placed_proxy = True
                             if placed_isolated_proxy:
@@ -368,7 +434,7 @@ class GridworldMdp(Mdp):
                             else:
                                 placed_isolated_proxy = True
                     else:
-                        obj_type_1 = np.random.choice(feature_dim)
+                        obj_type_1 = np_rng.choice(feature_dim)
                         placed_proxy = True
                     objects.append(obj_type_1)
                     goal = (x, y, objects)
@@ -401,37 +467,22 @@ class GridworldMdp(Mdp):
         required_nonwalls = list(goals_wo_type)
         required_nonwalls.append((start_x, start_y))
 
-        directions = [
-            Direction.NORTH,
-            Direction.SOUTH,
-            Direction.EAST,
-            Direction.WEST
-        ]
-
         grid = [['X'] * width for _ in range(height)]
-        walls = [(x, y) for x in range(1, width - 1) for y in range(1, height - 1)]
-        dsets = DisjointSets([])
-        first_state = required_nonwalls[0]
-        for x, y, in required_nonwalls:
-            grid[y][x] = ' '
-            walls.remove((x, y))
-            dsets.add_singleton((x, y))
-            dsets.union((x, y), first_state)
-
+        required_set = set(required_nonwalls)
+        walls = [(x, y) for x in range(1, width - 1) for y in range(1, height - 1) if (x, y) not in required_set]
         min_free_spots = (1 - pr_wall) * len(walls)
-        random.shuffle(walls)
-        while dsets.get_num_elements() < min_free_spots or not dsets.is_connected():
-            x, y = walls.pop()
+        if rng is None:
+            random.shuffle(walls)
+        else:
+            walls = [walls[i] for i in rng.permutation(len(walls))]
+        # Walls are removed from the end of the shuffled list
+        is_open = GridworldMdp.carve_connected_grid(height, width, required_nonwalls, walls[::-1], min_free_spots)
+        for y, x in zip(*np.nonzero(is_open)):
             grid[y][x] = ' '
-            dsets.add_singleton((x, y))
-            for direction in directions:
-                newx, newy = Direction.move_in_direction((x, y), direction)
-                if dsets.contains((newx, newy)):
-                    dsets.union((x, y), (newx, newy))
 
         grid[height // 2][width // 2] = 'A'
         for x, y in goals_wo_type:
-            grid[y][x] = random.randint(-9, 10)
+            grid[y][x] = random.randint(-9, 10) if rng is None else int(rng.integers(-9, 11))
 
         # Print grid
         if print_grid:
@@ -443,6 +494,61 @@ class GridworldMdp(Mdp):
                 print(str(row_new))
         return grid, goals
 
+    @staticmethod
+    def generate_random_batch(args, num_grids, height, width, pr_wall, feature_dim, seed, living_reward=0, noise=0,
+                              decorrelate=False):
+        """Generates num_grids random Gridworlds with generate_random and returns a list of (grid, goals) pairs.
+
+        Grid i is drawn with a generator seeded by the i-th child of np.random.SeedSequence(seed), so it doesn't
+        depend on the number of grids or on the global random states.
+        """
+        return [GridworldMdp.generate_random(args, height, width, pr_wall, feature_dim, living_reward=living_reward,
+                                             noise=noise, decorrelate=decorrelate, rng=np.random.default_rng(child))
+                for child in np.random.SeedSequence(seed).spawn(num_grids)]
+
+    @staticmethod
+    def carve_connected_grid(height, width, required_nonwalls, candidates, min_free_spots):
+        """Returns a height x width boolean array of the cells that aren't walls.
+
+        The required (x, y) cells are free, and the candidate cells are freed in order until at least min_free_spots
+        cells are free and every connected region of free cells contains a required cell. The required cells count as
+        connected to each other.
+
+        The first cells up to min_free_spots are freed at once and their regions are found with
+        scipy.ndimage.label. Cells after that are freed one at a time, tracking the regions with ArrayDisjointSets.
+        """
+        is_open = np.zeros([height, width], dtype=bool)
+        required_xs, required_ys = np.array(required_nonwalls).T
+        is_open[required_ys, required_xs] = True
+        num_free = int(is_open.sum())
+        num_bulk = min(max(math.ceil(min_free_spots) - num_free, 0), len(candidates))
+        if num_bulk > 0:
+            bulk_xs, bulk_ys = np.array(candidates[:num_bulk]).T
+            is_open[bulk_ys, bulk_xs] = True
+            num_free += num_bulk
+
+        # Region of each free cell, and -1 for walls
+        regions, num_regions = label(is_open)
+        regions -= 1
+        dsets = ArrayDisjointSets(num_regions)
+        first_region = int(regions[required_ys[0], required_xs[0]])
+        for region in regions[required_ys, required_xs].tolist():
+            dsets.union(region, first_region)
+
+        # Flat lists are much faster than indexing arrays one cell at a time
+        cell_regions = regions.ravel().tolist()
+        for x, y in candidates[num_bulk:]:
+            if dsets.is_connected():
+                break
+            cell = y * width + x
+            region = dsets.add_singleton()
+            cell_regions[cell] = region
+            # North, south, east and west
+            for neighbor in [cell - width, cell + width, cell + 1, cell - 1]:
+                if cell_regions[neighbor] >= 0:
+                    dsets.union(region, cell_regions[neighbor])
+        return np.reshape(cell_regions, [height, width]) >= 0
+
     def assert_valid_grid(self, grid):
         """Raises an AssertionError if the grid is invalid.
 
@@ -529,6 +635,30 @@ class GridworldMdp(Mdp):
         walls = np.array(self.walls, dtype=int)
         return walls, self.feature_matrix, self.start_state
 
+    def convert_to_sparse_numpy_input(self):
+        """Encodes the states that aren't walls for planners that skip walls.
+
+        Returns the num_states x feature_dim features of the non-wall states (in row-major order), a num_states x 4
+        array with the index of the state reached by moving north, south, east and west (num_states if the move
+        leads into a wall or off the grid), a num_states x 4 array of indicators for whether these moves are valid,
+        and the index of the start state.
+        """
+        walls = np.array(self.walls, dtype=bool)
+        ys, xs = np.nonzero(~walls)
+        num_states = len(ys)
+        # Pad with walls so that moving off the grid is like moving into a wall
+        state_index = np.full([self.height + 2, self.width + 2], num_states)
+        state_index[ys + 1, xs + 1] = np.arange(num_states)
+        neighbors = np.stack([
+            state_index[ys, xs + 1],  # North
+            state_index[ys + 2, xs + 1],  # South
+            state_index[ys + 1, xs + 2],  # East
+            state_index[ys + 1, xs]  # West
+        ], axis=1)
+        valid_actions = (neighbors < num_states).astype(np.float32)
+        start_x, start_y = self.start_state
+        return self.feature_matrix[ys, xs], neighbors, valid_actions, state_index[start_y + 1, start_x + 1]
+
     def get_start_state(self):
         """Returns the start state."""
         return self.start_state
@@ -675,13 +805,40 @@ class GridworldMdpWithFeatures(GridworldMdp):
 class GridworldMdpWithDistanceFeatures(GridworldMdpWithFeatures):
     """Features are based on distance to places with reward."""
 
-    def __init__(self, grid, goals, args, dist_scale=0.5, living_reward=-0.01, noise=0, rewards=None):
+    def __init__(self, grid, goals, args, dist_scale=0.5, living_reward=-0.01, noise=0, rewards=None,
+                 feature_matrix=None):
+        """feature_matrix: Features computed earlier for the same grid and goals, such as ones loaded from an
+        env_cache. If given, they aren't recomputed."""
         self.dist_scale = dist_scale
         self.goals = goals
+        self.precomputed_feature_matrix = feature_matrix
         # self.feature_weights = None
         self.linear_features = args.linear_features
         super(GridworldMdpWithDistanceFeatures, self).__init__(
-            grid, args, living_reward=-0.01, noise=0)
+            grid, args, living_reward=-0.01, noise=noise)
+
+    @staticmethod
+    def generate_random_mdps(args, num_mdps, height, width, pr_wall, seed, dist_scale=0.5, noise=0, decorrelate=False,
+                             num_workers=1):
+        """Generates num_mdps random MDPs. Grid i is the i-th grid of GridworldMdp.generate_random_batch, so it is drawn
+        with a generator seeded by the i-th child of np.random.SeedSequence(seed).
+
+        With num_workers > 1, the grids and their features are generated in a pool of processes. Each MDP only depends
+        on its own seed, so the MDPs are the same for any number of workers.
+        """
+        generate_mdp = partial(GridworldMdpWithDistanceFeatures.generate_random_from_seed,
+                               args, height, width, pr_wall, dist_scale, noise, decorrelate)
+        seed_sequences = np.random.SeedSequence(seed).spawn(num_mdps)
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                return pool.map(generate_mdp, seed_sequences)
+        return [generate_mdp(seed_sequence) for seed_sequence in seed_sequences]
+
+    @staticmethod
+    def generate_random_from_seed(args, height, width, pr_wall, dist_scale, noise, decorrelate, seed_sequence):
+        grid, goals = GridworldMdp.generate_random(args, height, width, pr_wall, args.feature_dim,
+                                                   decorrelate=decorrelate, rng=np.random.default_rng(seed_sequence))
+        return GridworldMdpWithDistanceFeatures(grid, goals, args, dist_scale, living_reward=-0.01, noise=noise)
 
     def populate_features(self):
         self.populate_features_and_start_state()
@@ -710,23 +867,31 @@ class GridworldMdpWithDistanceFeatures(GridworldMdpWithFeatures):
                 if self.grid[y][x] == 'A':
                     self.start_state = (x, y)
 
+        if self.precomputed_feature_matrix is not None:
+            self.feature_matrix = self.precomputed_feature_matrix
+            return
+
         height, width = len(self.grid), len(self.grid[0])
         self.feature_matrix = np.zeros([height, width, self.args.feature_dim])
-        # Save features for each state based on distance to goals
-        for y in range(1, height - 1):
-            for x in range(1, width - 1):
-                features = np.zeros(self.args.feature_dim)
-                for i, j, obj_nums in self.goals:
-                    distance = np.linalg.norm(np.array((x, y)) - np.array((i, j)))
-                    rbf_nearness = np.exp(- self.dist_scale * distance)
-                    feat_value = -distance / 5. if self.linear_features and not self.args.repeated_obj \
-                        else rbf_nearness
-
-                    'Featurization for different object types:'
-                    for obj_num in obj_nums:
-                        features[obj_num] += feat_value
-
-                self.feature_matrix[y, x, :] = features
+        # Save features for each state based on distance to goals, for all states inside the border at once
+        ys, xs = np.mgrid[1:height - 1, 1:width - 1]
+        goal_xs = np.array([i for i, j, obj_nums in self.goals], dtype=float)
+        goal_ys = np.array([j for i, j, obj_nums in self.goals], dtype=float)
+        # num_goals x (height - 2) x (width - 2)
+        distances = np.sqrt((xs - goal_xs[:, None, None]) ** 2 + (ys - goal_ys[:, None, None]) ** 2)
+        if self.linear_features and not self.args.repeated_obj:
+            feat_values = -distances / 5.
+        else:
+            feat_values = np.exp(- self.dist_scale * distances)
+
+        'Featurization for different object types:'
+        # Add each goal's values to the channel of each of its objects. np.add.at adds in the same order as looping
+        # over the goals and objects, so the sums are exactly the same.
+        goal_idx = [g for g, (i, j, obj_nums) in enumerate(self.goals) for _ in obj_nums]
+        obj_idx = [obj_num for i, j, obj_nums in self.goals for obj_num in obj_nums]
+        features = np.zeros([self.args.feature_dim, height - 2, width - 2])
+        np.add.at(features, np.array(obj_idx, dtype=int), feat_values[np.array(goal_idx, dtype=int)])
+        self.feature_matrix[1:-1, 1:-1] = features.transpose([1, 2, 0])
 
 
 class GridworldEnvironment(object):
@@ -1,7 +1,10 @@
+import argparse
 import random
 import unittest
 
-from gridworld import Direction, GridworldEnvironment, GridworldMdp
+import numpy as np
+
+from gridworld import Direction, GridworldEnvironment, GridworldMdp, NStateMdpStreamedGaussianFeatures
 
 
 class TestDirection(unittest.TestCase):
@@ -257,5 +260,59 @@ class TestGridworld(unittest.TestCase):
         self.assertEqual(mdp_string.count('3'), 1)
 
 
+class TestRandomGridworldBatch(unittest.TestCase):
+    def test_batch_is_reproducible(self):
+        args = argparse.Namespace(repeated_obj=0)
+        grids = GridworldMdp.generate_random_batch(args, 4, 10, 12, 0.35, 5, seed=7)
+        self.assertEqual(GridworldMdp.generate_random_batch(args, 2, 10, 12, 0.35, 5, seed=7), grids[:2])
+        self.assertNotEqual(GridworldMdp.generate_random_batch(args, 1, 10, 12, 0.35, 5, seed=8), grids[:1])
+        for grid, goals in grids:
+            mdp = GridworldMdp(grid, args)
+            self.assertEqual((mdp.height, mdp.width), (10, 12))
+            self.assertEqual(len(goals), 5)
+            for x, y, _ in goals:
+                self.assertFalse(mdp.walls[y][x])
+
+
+class TestSparseGridworldInput(unittest.TestCase):
+    def setUp(self):
+        self.grid = ['XXXXX',
+                     'X  AX',
+                     'X X X',
+                     'X  1X',
+                     'XXXXX']
+        self.mdp = GridworldMdp(self.grid, None)
+        self.mdp.start_state = (3, 1)
+        self.mdp.feature_matrix = np.arange(25 * 2, dtype=float).reshape([5, 5, 2])
+
+    def test_sparse_input(self):
+        features, neighbors, valid_actions, start_index = self.mdp.convert_to_sparse_numpy_input()
+        states = [(1, 1), (2, 1), (3, 1), (1, 2), (3, 2), (1, 3), (2, 3), (3, 3)]
+        self.assertEqual(len(features), len(states))
+        for i, (x, y) in enumerate(states):
+            self.assertTrue(np.array_equal(features[i], self.mdp.feature_matrix[y, x]))
+        self.assertEqual(states[start_index], (3, 1))
+
+        # North, south, east, west of (2, 1): wall, wall, (3, 1), (1, 1)
+        self.assertEqual(list(neighbors[1]), [8, 8, 2, 0])
+        self.assertEqual(list(valid_actions[1]), [0, 0, 1, 1])
+        # North, south, east, west of (1, 2): (1, 1), (1, 3), wall, wall
+        self.assertEqual(list(neighbors[3]), [0, 5, 8, 8])
+        self.assertEqual(list(valid_actions[3]), [1, 1, 0, 0])
+
+
+class TestStreamedGaussianFeatures(unittest.TestCase):
+    def test_features_are_reproducible(self):
+        mdp = NStateMdpStreamedGaussianFeatures(25, np.zeros(3), 0, [], 3, 25, SEED=4, block_size=10)
+        features = mdp.convert_to_numpy_input()
+        self.assertEqual(features.shape, (25, 3))
+        for state in [0, 9, 10, 24]:
+            self.assertTrue(np.array_equal(mdp.get_features(state), features[state]))
+        same_seed = NStateMdpStreamedGaussianFeatures(25, np.zeros(3), 0, [], 3, 25, SEED=4, block_size=10)
+        self.assertTrue(np.array_equal(same_seed.convert_to_numpy_input(), features))
+        other_seed = NStateMdpStreamedGaussianFeatures(25, np.zeros(3), 0, [], 3, 25, SEED=5, block_size=10)
+        self.assertFalse(np.array_equal(other_seed.convert_to_numpy_input(), features))
+
+
 if __name__ == '__main__':
     unittest.main()
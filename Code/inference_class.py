@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.special import logsumexp
 
 
 class Inference(object):
@@ -14,7 +15,7 @@ class Inference(object):
         self.beta = beta
         self.reward_space_proxy = reward_space_proxy
         self.reward_space_true = reward_space_true
-        self.true_reward_matrix = self.reward_space_true
+        self.log_likelihood_matrix = None
         self.reset_prior()
         self.make_reward_to_index_dict()
 
@@ -24,6 +25,7 @@ class Inference(object):
         if true_log_posterior is not None:
             self.log_prior = true_log_posterior
             self.prior = np.exp(true_log_posterior)
+            self.prior_cdf = None
         # TODO(rohinmshah): Can the elif case be removed? (soerenmind): It would break if query is None
         elif len(query) == 0:  # Do nothing for empty query
             return
@@ -32,10 +34,81 @@ class Inference(object):
             self.prior = self.get_full_posterior(query, answer)
 
     def reset_prior(self):
-        '''Resets to uniform prior'''
+        '''Resets to uniform prior over the whole true reward space. The uniform log_prior and prior are read-only
+        views of a single value, so they don't take memory proportional to the size of the space until the prior is
+        updated.'''
         num_rewards = len(self.reward_space_true)
-        self.log_prior = np.tile(-np.log(num_rewards), num_rewards)
+        self.support_idx = None
+        self.true_reward_matrix = self.reward_space_true
+        self.log_prior = np.broadcast_to(-np.log(num_rewards), [num_rewards])
+        self.prior = np.broadcast_to(np.exp(self.log_prior[0]), [num_rewards])
+        self.prior_cdf = None
+
+    def prune_support(self, tolerance):
+        """Drops the least likely true rewards whose total prior mass is at most tolerance and renormalizes the prior
+        over the rest. Afterwards true_reward_matrix, log_prior and prior only cover the active support, and
+        support_idx holds its indices into reward_space_true. reset_prior restores the whole space.
+        Returns the discarded mass."""
+        order = np.argsort(self.log_prior)
+        cum_mass = np.cumsum(np.exp(self.log_prior[order]))
+        cum_mass /= cum_mass[-1]
+        num_dropped = min(np.searchsorted(cum_mass, tolerance, side='right'), len(order) - 1)
+        if num_dropped == 0:
+            return 0.
+        discarded_mass = cum_mass[num_dropped - 1]
+
+        keep = np.sort(order[num_dropped:])
+        log_prior = self.log_prior[keep]
+        max_log_prior = log_prior.max()
+        self.log_prior = log_prior - max_log_prior - np.log(np.exp(log_prior - max_log_prior).sum())
         self.prior = np.exp(self.log_prior)
+        self.prior_cdf = None
+        self.support_idx = keep if self.support_idx is None else self.support_idx[keep]
+        self.true_reward_matrix = self.reward_space_true[self.support_idx]
+        print('Pruned support to {n} true rewards, discarding {mass:.2e} of the mass'.format(
+            n=len(keep), mass=discarded_mass))
+        return discarded_mass
+
+    def sample_true_reward_idx(self, size):
+        """Draws indices into true_reward_matrix according to the prior. size may be a shape for batched draws.
+        The cumulative prior is cached until the prior changes, so each draw costs O(log size_true). Draws are the
+        same as those of np.random.choice(len(log_prior), p=normalized prior, size=size)."""
+        if self.prior_cdf is None:
+            probs = np.exp(self.log_prior)
+            probs = probs / probs.sum()
+            self.prior_cdf = probs.cumsum()
+            self.prior_cdf /= self.prior_cdf[-1]
+        return self.prior_cdf.searchsorted(np.random.random_sample(size), side='right')
+
+    def get_posterior_summary(self, quantiles=(), chunk_size=100000):
+        """Computes the exact mean and variance of each feature weight under the prior, and the given quantiles
+        (inverse cdf, e.g. 0.5 for the median).
+        Returns mean, variance and a len(quantiles) x feature_dim array of quantiles."""
+        probs = np.exp(self.log_prior)
+        probs = probs / probs.sum()
+        mean, second_moment = np.zeros(self.true_reward_matrix.shape[1]), np.zeros(self.true_reward_matrix.shape[1])
+        for start in range(0, len(probs), chunk_size):
+            true_rewards = np.asarray(self.true_reward_matrix[start:start + chunk_size], dtype=np.float64)
+            chunk_probs = probs[start:start + chunk_size]
+            mean += np.dot(chunk_probs, true_rewards)
+            second_moment += np.dot(chunk_probs, true_rewards ** 2)
+        variance = np.maximum(second_moment - mean ** 2, 0)
+
+        quantile_values = np.empty([len(quantiles), len(mean)])
+        if len(quantiles) == 0:
+            return mean, variance, quantile_values
+        for i in range(len(mean)):
+            feature_weights = np.asarray(self.true_reward_matrix[:, i])
+            if np.issubdtype(feature_weights.dtype, np.integer):
+                min_weight = feature_weights.min()
+                cdf = np.cumsum(np.bincount(feature_weights - min_weight, weights=probs))
+                quantile_values[:, i] = min_weight + np.searchsorted(cdf, np.multiply(quantiles, cdf[-1]))
+            else:
+                order = np.argsort(feature_weights)
+                cdf = np.cumsum(probs[order])
+                idx = np.minimum(np.searchsorted(cdf, np.multiply(quantiles, cdf[-1])), len(order) - 1)
+                quantile_values[:, i] = feature_weights[order[idx]]
+        return mean, variance, quantile_values
 
     def make_reward_to_index_dict(self):
         """Creates dictionary from proxy reward tuples to their index in proxy space. If index_true_space, it does the
@@ -43,3 +116,133 @@ class Inference(object):
         self.reward_index_proxy = {}
         for i, proxy in enumerate(self.reward_space_proxy):
             self.reward_index_proxy[tuple(proxy)] = i
+
+    def cache_log_likelihoods(self, dtype='float32', max_megabytes=None, chunk_size=100000):
+        """Precomputes the size_proxy x size_true matrix beta * feature_exp_matrix . reward_space_true^T of
+        unnormalized log likelihoods and stores it in self.log_likelihood_matrix. Requires self.feature_exp_matrix.
+        If the matrix would take more than max_megabytes, nothing is cached and None is returned."""
+        num_proxies, num_true = len(self.feature_exp_matrix), len(self.reward_space_true)
+        dtype = np.dtype(dtype)
+        megabytes = num_proxies * num_true * dtype.itemsize / 1e6
+        if max_megabytes is not None and megabytes > max_megabytes:
+            print('Not caching log likelihoods: {mb:.0f}MB exceeds budget of {max}MB'.format(
+                mb=megabytes, max=max_megabytes))
+            self.log_likelihood_matrix = None
+            return None
+
+        self.log_likelihood_matrix = np.empty([num_proxies, num_true], dtype=dtype)
+        feature_exp_matrix = np.asarray(self.feature_exp_matrix, dtype=np.float32)
+        for start in range(0, num_true, chunk_size):
+            true_rewards = np.asarray(self.reward_space_true[start:start + chunk_size], dtype=np.float32)
+            self.log_likelihood_matrix[:, start:start + chunk_size] = \
+                self.beta * np.dot(feature_exp_matrix, true_rewards.T)
+        return self.log_likelihood_matrix
+
+    def get_log_likelihoods(self, proxy_idx, true_idx=None):
+        """Gathers the cached log likelihoods of the proxies at proxy_idx for the true rewards at true_idx (all true
+        rewards if None). true_idx indexes true_reward_matrix, i.e. the active support if it was pruned."""
+        log_likelihoods = self.log_likelihood_matrix[proxy_idx]
+        if self.support_idx is not None:
+            true_idx = self.support_idx if true_idx is None else self.support_idx[true_idx]
+        if true_idx is not None:
+            log_likelihoods = log_likelihoods[:, true_idx]
+        return log_likelihoods
+
+
+class ParticleInference(Inference):
+    def __init__(self, mdp, env, beta, reward_space_true, reward_space_proxy, num_particles, ess_threshold=0.5,
+                 rejuvenation_steps=1):
+        """
+        Represents the belief by num_particles weighted true rewards instead of a log prior over all of
+        reward_space_true. The particles are exposed as true_reward_matrix and their log weights as log_prior, so
+        query choosers and models use them like an enumerated true reward space.
+
+        :param reward_space_true: Array of true rewards to draw the initial particles from. Rejuvenated particles
+            stay within its per-feature range.
+        :param num_particles: Number of particles
+        :param ess_threshold: Resample when the effective sample size falls below this fraction of num_particles
+        :param rejuvenation_steps: Number of Metropolis-Hastings sweeps over the particles after resampling
+        """
+        self.num_particles = num_particles
+        self.ess_threshold = ess_threshold
+        self.rejuvenation_steps = rejuvenation_steps
+        reward_space_true = np.asarray(reward_space_true)
+        self.reward_min, self.reward_max = reward_space_true.min(axis=0), reward_space_true.max(axis=0)
+        self.initial_particles = reward_space_true[np.random.choice(len(reward_space_true), num_particles)]
+        super(ParticleInference, self).__init__(mdp, env, beta, reward_space_true, reward_space_proxy)
+
+    def update_prior(self, query, answer, true_log_posterior=None):
+        """Reweights the particles with true_log_posterior. query are the feature expectations of the proxies in the
+        query and answer the index of the chosen one; they are kept to rejuvenate particles after resampling."""
+        if true_log_posterior is None:
+            raise ValueError('ParticleInference needs the posterior over the particles')
+        self.log_prior = true_log_posterior
+        self.prior = np.exp(true_log_posterior)
+        self.prior_cdf = None
+        if query is not None:
+            self.history.append((np.asarray(query, dtype=np.float64), answer))
+
+        self.ess = 1. / np.sum(self.prior ** 2)
+        print('Effective sample size: {ess:.0f}/{n}'.format(ess=self.ess, n=self.num_particles))
+        if self.ess < self.ess_threshold * self.num_particles:
+            self.resample()
+            acceptance_rates = [self.rejuvenate() for _ in range(self.rejuvenation_steps)]
+            if acceptance_rates:
+                print('Resampled particles. Rejuvenation acceptance rate: {rate:.2f}'.format(
+                    rate=np.mean(acceptance_rates)))
+
+    def reset_prior(self):
+        '''Resets to the initial, uniformly weighted particles'''
+        self.support_idx = None
+        self.history = []
+        self.true_reward_matrix = self.initial_particles.copy()
+        self.log_prior = np.tile(-np.log(self.num_particles), self.num_particles)
+        self.prior = np.exp(self.log_prior)
+        self.prior_cdf = None
+        self.ess = float(self.num_particles)
+
+    def resample(self):
+        """Systematic resampling. Afterwards all particles have the same weight."""
+        positions = (np.random.random_sample() + np.arange(self.num_particles)) / self.num_particles
+        cum_weights = np.cumsum(self.prior)
+        idx = np.minimum(np.searchsorted(cum_weights, positions * cum_weights[-1]), self.num_particles - 1)
+        self.true_reward_matrix = self.true_reward_matrix[idx]
+        self.log_prior = np.tile(-np.log(self.num_particles), self.num_particles)
+        self.prior = np.exp(self.log_prior)
+        self.prior_cdf = None
+        self.ess = float(self.num_particles)
+
+    def get_history_log_likelihood(self, particles):
+        """Log likelihood of all answers so far for each particle."""
+        log_likelihood = np.zeros(len(particles))
+        particles = particles.astype(np.float64)
+        for query_feature_exps, answer in self.history:
+            log_answer_probs = self.beta * np.dot(particles, query_feature_exps.T)
+            log_likelihood += log_answer_probs[:, answer] - logsumexp(log_answer_probs, axis=1)
+        return log_likelihood
+
+    def rejuvenate(self):
+        """One Metropolis-Hastings sweep over equally weighted particles. Each particle proposes to move one random
+        feature weight by +-1 and the move is accepted based on the likelihood of all answers so far. Since the
+        prior is uniform and the proposal symmetric, the particles stay distributed according to the posterior.
+        Returns the acceptance rate."""
+        particles = self.true_reward_matrix
+        num_particles, dim = particles.shape
+        proposals = particles.copy()
+        features = np.random.randint(dim, size=num_particles)
+        steps = np.random.choice([-1, 1], size=num_particles)
+        proposals[np.arange(num_particles), features] += steps.astype(particles.dtype)
+        in_range = np.all((proposals >= self.reward_min) & (proposals <= self.reward_max), axis=1)
+
+        log_accept = self.get_history_log_likelihood(proposals) - self.get_history_log_likelihood(particles)
+        accept = in_range & (np.log(np.random.random_sample(num_particles)) < log_accept)
+        self.true_reward_matrix = np.where(accept[:, None], proposals, particles)
+        return accept.mean()
+
+    def prune_support(self, tolerance):
+        raise NotImplementedError('Particles with negligible weight are dropped by resampling instead')
+
+    def cache_log_likelihoods(self, dtype='float32', max_megabytes=None, chunk_size=100000):
+        """Particles move when they are rejuvenated, so their log likelihoods are not cached."""
+        self.log_likelihood_matrix = None
+        return None
@@ -0,0 +1,177 @@
+import unittest
+
+import numpy as np
+from scipy.special import logsumexp
+
+from inference_class import Inference, ParticleInference
+
+
+def make_inference(size_true=200, size_proxy=5, dim=3):
+    reward_space_true = np.random.randint(-9, 10, size=[size_true, dim])
+    reward_space_proxy = np.random.randint(-9, 10, size=[size_proxy, dim])
+    return Inference(None, None, 0.5, reward_space_true, reward_space_proxy)
+
+
+def random_log_posterior(size, scale=3.):
+    log_posterior = scale * np.random.randn(size)
+    return log_posterior - logsumexp(log_posterior)
+
+
+class TestSupportPruning(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.inference = make_inference()
+        self.inference.update_prior(None, None, random_log_posterior(200))
+        self.inference.feature_exp_matrix = np.random.randn(5, 3)
+        self.inference.cache_log_likelihoods()
+
+    def test_discarded_mass(self):
+        full_prior = self.inference.prior.copy()
+        discarded_mass = self.inference.prune_support(0.01)
+        support_idx = self.inference.support_idx
+        self.assertLess(len(support_idx), len(full_prior))
+        self.assertLessEqual(discarded_mass, 0.01)
+        self.assertAlmostEqual(discarded_mass, 1 - full_prior[support_idx].sum())
+        # Only the least likely rewards are dropped
+        dropped = np.setdiff1d(np.arange(len(full_prior)), support_idx)
+        self.assertLessEqual(full_prior[dropped].max(), full_prior[support_idx].min())
+        np.testing.assert_allclose(self.inference.prior, full_prior[support_idx] / full_prior[support_idx].sum())
+        np.testing.assert_array_equal(self.inference.true_reward_matrix,
+                                      self.inference.reward_space_true[support_idx])
+
+    def test_posterior_matches_unpruned(self):
+        answer = 2
+        full_log_posterior = self.inference.log_prior + self.inference.get_log_likelihoods([answer])[0]
+        full_log_posterior -= logsumexp(full_log_posterior)
+        self.inference.prune_support(0.01)
+        support_idx = self.inference.support_idx
+        log_posterior = self.inference.log_prior + self.inference.get_log_likelihoods([answer])[0]
+        log_posterior -= logsumexp(log_posterior)
+        # The pruned posterior is the unpruned one conditioned on the support
+        support_mass = np.exp(full_log_posterior[support_idx]).sum()
+        np.testing.assert_allclose(np.exp(log_posterior), np.exp(full_log_posterior[support_idx]) / support_mass,
+                                   rtol=1e-5)
+
+    def test_reset_prior(self):
+        self.inference.prune_support(0.01)
+        self.inference.reset_prior()
+        self.assertIsNone(self.inference.support_idx)
+        self.assertEqual(len(self.inference.prior), 200)
+        self.assertAlmostEqual(self.inference.prior.sum(), 1)
+
+
+class TestParticleInference(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.num_particles = 100
+        self.inference = ParticleInference(
+            None, None, 0.5, np.random.randint(-9, 10, size=[200, 3]), np.random.randint(-9, 10, size=[5, 3]),
+            self.num_particles, ess_threshold=0.5, rejuvenation_steps=0)
+
+    def test_reweighting_keeps_particles(self):
+        particles = self.inference.true_reward_matrix.copy()
+        log_weights = random_log_posterior(self.num_particles, scale=0.5)
+        self.inference.update_prior(None, None, log_weights)
+        weights = np.exp(log_weights)
+        self.assertAlmostEqual(self.inference.ess, 1 / np.sum(weights ** 2))
+        self.assertGreater(self.inference.ess, 0.5 * self.num_particles)
+        np.testing.assert_array_equal(self.inference.true_reward_matrix, particles)
+        np.testing.assert_allclose(self.inference.prior, weights)
+
+    def test_resampling(self):
+        particles = self.inference.true_reward_matrix.copy()
+        weights = np.zeros(self.num_particles)
+        weights[[3, 7]] = [0.25, 0.75]
+        with np.errstate(divide='ignore'):
+            self.inference.update_prior(None, None, np.log(weights))
+        # Systematic resampling copies each particle within one of num_particles * weight times
+        counts = [np.all(self.inference.true_reward_matrix == particles[i], axis=1).sum() for i in [3, 7]]
+        self.assertEqual(sum(counts), self.num_particles)
+        self.assertLessEqual(abs(counts[0] - 25), 1)
+        self.assertEqual(self.inference.ess, self.num_particles)
+        np.testing.assert_allclose(self.inference.prior, np.full(self.num_particles, 1. / self.num_particles))
+
+    def test_rejuvenation(self):
+        particles = self.inference.true_reward_matrix.copy()
+        self.inference.history.append((np.random.randn(2, 3), 0))
+        acceptance_rate = self.inference.rejuvenate()
+        moves = np.abs(self.inference.true_reward_matrix - particles)
+        self.assertTrue(np.all(moves.sum(axis=1) <= 1))
+        self.assertAlmostEqual(acceptance_rate, np.mean(moves.sum(axis=1)))
+        self.assertTrue(np.all(self.inference.true_reward_matrix >= self.inference.reward_min))
+        self.assertTrue(np.all(self.inference.true_reward_matrix <= self.inference.reward_max))
+
+    def test_reset_prior(self):
+        initial_particles = self.inference.true_reward_matrix.copy()
+        weights = np.zeros(self.num_particles)
+        weights[0] = 1
+        with np.errstate(divide='ignore'):
+            self.inference.update_prior(None, None, np.log(weights))
+        self.inference.reset_prior()
+        np.testing.assert_array_equal(self.inference.true_reward_matrix, initial_particles)
+        self.assertEqual(self.inference.ess, self.num_particles)
+
+
+class TestSampler(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.inference = make_inference()
+        self.inference.update_prior(None, None, random_log_posterior(200))
+
+    def check_draws_match_choice(self, size):
+        probs = np.exp(self.inference.log_prior)
+        np.random.seed(1)
+        expected = np.random.choice(len(probs), p=probs / probs.sum(), size=size)
+        np.random.seed(1)
+        np.testing.assert_array_equal(self.inference.sample_true_reward_idx(size), expected)
+
+    def test_draws_match_choice(self):
+        self.check_draws_match_choice(1000)
+        # The cached cumulative prior gives the same draws
+        self.check_draws_match_choice([10, 30])
+
+    def test_draws_after_prior_changes(self):
+        self.check_draws_match_choice(100)
+        self.inference.update_prior(None, None, random_log_posterior(200))
+        self.check_draws_match_choice(100)
+        self.inference.prune_support(0.1)
+        self.check_draws_match_choice(100)
+
+
+class TestPosteriorSummary(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.inference = make_inference()
+        self.inference.update_prior(None, None, random_log_posterior(200))
+
+    def check_summary(self, true_reward_matrix):
+        probs = self.inference.prior
+        quantiles = (0.1, 0.5, 0.9)
+        mean, variance, quantile_values = self.inference.get_posterior_summary(quantiles, chunk_size=7)
+        expected_mean = np.average(true_reward_matrix, weights=probs, axis=0)
+        np.testing.assert_allclose(mean, expected_mean)
+        np.testing.assert_allclose(variance, np.average((true_reward_matrix - expected_mean) ** 2, weights=probs,
+                                                        axis=0), atol=1e-10)
+        for i in range(true_reward_matrix.shape[1]):
+            order = np.argsort(true_reward_matrix[:, i], kind='stable')
+            cdf = np.cumsum(probs[order])
+            for q, value in zip(quantiles, quantile_values[:, i]):
+                # The smallest weight with at least mass q at or below it
+                self.assertEqual(value, true_reward_matrix[order[np.argmax(cdf >= q)], i])
+
+    def test_integer_rewards(self):
+        self.check_summary(self.inference.true_reward_matrix)
+
+    def test_float_rewards(self):
+        self.inference.true_reward_matrix = self.inference.true_reward_matrix + np.random.rand(200, 3)
+        self.check_summary(self.inference.true_reward_matrix)
+
+    def test_no_quantiles(self):
+        mean, variance, quantile_values = self.inference.get_posterior_summary()
+        self.assertEqual(quantile_values.shape, (0, 3))
+        np.testing.assert_allclose(mean, np.average(self.inference.true_reward_matrix, weights=self.inference.prior,
+                                                    axis=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,61 @@
 from itertools import product
 
+import numpy as np
 import tensorflow as tf
 
+from gridworld import NStateMdpStreamedGaussianFeatures
+
 tf.compat.v1.disable_eager_execution()  # needed until upgrade to save model instead of placeholder
 
 
+class ResidentBelief(object):
+    """Keeps the true reward matrix and log prior in TF variables, so that they don't have to be fed on every call.
+
+    Models built with a ResidentBelief read from these variables unless the placeholders are fed. An array is only
+    copied into its variable if it is not the array that was loaded last, i.e. once per experiment for the true reward
+    matrix and whenever Inference.update_prior replaces the log prior.
+    """
+
+    def __init__(self, feature_dim):
+        # Local variables so that global_variables_initializer of later models doesn't reset them
+        local = [tf.compat.v1.GraphKeys.LOCAL_VARIABLES]
+        self.true_reward_matrix = tf.compat.v1.Variable(
+            tf.zeros([0, feature_dim]), trainable=False, collections=local, use_resource=True,
+            shape=[None, feature_dim], name='resident_true_reward_matrix')
+        self.log_prior = tf.compat.v1.Variable(
+            tf.zeros([0]), trainable=False, collections=local, use_resource=True,
+            shape=[None], name='resident_log_prior')
+
+        self.true_reward_matrix_input = tf.compat.v1.placeholder(
+            tf.float32, shape=[None, feature_dim], name='true_reward_matrix_input')
+        self.log_prior_input = tf.compat.v1.placeholder(tf.float32, shape=[None], name='log_prior_input')
+        self.assign_true_reward_matrix = self.true_reward_matrix.assign(self.true_reward_matrix_input)
+        self.assign_log_prior = self.log_prior.assign(self.log_prior_input)
+
+        self.loaded_true_reward_matrix = None
+        self.loaded_log_prior = None
+
+    def load(self, sess, true_reward_matrix=None, log_prior=None):
+        """Copies the arrays into the variables unless they are already loaded."""
+        ops, fd = [], {}
+        if true_reward_matrix is not None and true_reward_matrix is not self.loaded_true_reward_matrix:
+            ops.append(self.assign_true_reward_matrix)
+            fd[self.true_reward_matrix_input] = true_reward_matrix
+            self.loaded_true_reward_matrix = true_reward_matrix
+        if log_prior is not None and log_prior is not self.loaded_log_prior:
+            ops.append(self.assign_log_prior)
+            fd[self.log_prior_input] = log_prior
+            self.loaded_log_prior = log_prior
+        if ops:
+            sess.run(ops, feed_dict=fd)
+
+
 class Model(object):
     def __init__(self, feature_dim, gamma, query_size, discretization_size,
                  true_reward_space_size, num_unknown, beta, beta_planner,
-                 objective, lr, discrete, optimize, args):
+                 objective, lr, discrete, optimize, args, resident_belief=None):
         self.initialized = False
+        self.resident_belief = resident_belief
         self.feature_dim = feature_dim
         self.gamma = gamma
         self.query_size = query_size
@@ -44,10 +90,20 @@ class Model(object):
 
     def build_tf_graph(self, objective):
         self.name_to_op = {}
-        self.build_weights()
-        self.build_planner()
-        self.build_map_to_posterior()
-        self.build_map_to_objective(objective)
+        # Differentiating through loops that use the outputs of other loops needs their intermediates. Only keep them
+        # when optimizing through the chunked posterior, otherwise the loops would accumulate the full K x size_true
+        # joint again. The setting is global to TF, so the default is restored once the graph is built.
+        keep_intermediates = bool(self.optimize and self.args.posterior_block_size)
+        if keep_intermediates:
+            tf.compat.v1.experimental.output_all_intermediates(True)
+        try:
+            self.build_weights()
+            self.build_planner()
+            self.build_map_to_posterior()
+            self.build_map_to_objective(objective)
+        finally:
+            if keep_intermediates:
+                tf.compat.v1.experimental.output_all_intermediates(None)
         # Initializing the variables
         self.initialize_op = tf.compat.v1.global_variables_initializer()
 
@@ -60,7 +116,7 @@ class Model(object):
             self.build_continuous_weights()
 
     def build_discrete_weights_for_optimization(self):
-        K, N = self.K, self.num_unknown
+        N = self.num_unknown
         dim = self.feature_dim
         self.weights_to_train = tf.Variable(
             tf.zeros([N, dim]), name="weights_to_train")
@@ -68,20 +124,18 @@ class Model(object):
             tf.float32, shape=[N, dim], name="weight_inputs")
         self.assign_op = self.weights_to_train.assign(self.weight_inputs)
 
-        if N < K:
-            self.known_weights = tf.compat.v1.placeholder(
-                tf.float32, shape=[K - N, dim], name="known_weights")
-            self.weights = tf.concat(
-                [self.known_weights, self.weights_to_train], axis=0, name="weights")
-        else:
-            self.weights = self.weights_to_train
+        # Any number of known weights, none if not fed
+        self.known_weights = tf.compat.v1.placeholder_with_default(
+            tf.zeros([0, dim]), shape=[None, dim], name="known_weights")
+        self.weights = tf.concat(
+            [self.known_weights, self.weights_to_train], axis=0, name="weights")
 
         self.name_to_op['weights'] = self.weights
         self.name_to_op['weights_to_train'] = self.weights_to_train
 
     def build_discrete_weights(self):
         self.weights = tf.compat.v1.placeholder(
-            tf.float32, shape=[self.K, self.feature_dim], name="weights")
+            tf.float32, shape=[None, self.feature_dim], name="weights")
 
     def build_continuous_weights(self):
         query_size, dim, K = self.query_size, self.feature_dim, self.K
@@ -126,35 +180,132 @@ class Model(object):
         """
         Maps self.feature_exp (created by planner) to self.log_posterior.
         """
-        # Get log likelihoods for true reward matrix
+        self.chunked_posterior = bool(self.args.posterior_block_size)
+        if self.chunked_posterior:
+            self.build_chunked_log_posterior()
+        else:
+            self.build_log_posterior()
+        self.build_true_posterior()
+
+    def build_belief_inputs(self):
+        """Creates the inputs for the true reward matrix and the log prior over it."""
         true_reward_space_size = self.true_reward_space_size
         dim = self.feature_dim
-        self.true_reward_matrix = tf.compat.v1.placeholder(
-            tf.float32, [true_reward_space_size, dim], name="true_reward_matrix")
+        if self.resident_belief is None:
+            self.true_reward_matrix = tf.compat.v1.placeholder(
+                tf.float32, [true_reward_space_size, dim], name="true_reward_matrix")
+            # self.prior = tf.compat.v1.placeholder(tf.float32, name="prior", shape=(true_reward_space_size))
+            self.log_prior = tf.compat.v1.placeholder(tf.float32, name="log_prior", shape=(true_reward_space_size))
+        else:
+            self.true_reward_matrix = tf.compat.v1.placeholder_with_default(
+                self.resident_belief.true_reward_matrix.read_value(), [true_reward_space_size, dim],
+                name="true_reward_matrix")
+            self.log_prior = tf.compat.v1.placeholder_with_default(
+                self.resident_belief.log_prior.read_value(), name="log_prior", shape=(true_reward_space_size))
+        self.name_to_op['true_reward_matrix'] = self.true_reward_matrix
+        self.name_to_op['log_prior'] = self.log_prior
+
+    def build_log_posterior(self):
+        """
+        Maps self.feature_exp to the posterior for every answer. Only reduces over the last two axes (answers and true
+        rewards) so that it also works with a leading batch dimension.
+        """
+        # Get log likelihoods for true reward matrix
+        self.build_belief_inputs()
         self.log_true_reward_matrix = tf.compat.v1.log(self.true_reward_matrix, name='log_true_reward_matrix')
 
-        # TODO: Inefficient to recompute this matrix on every forward pass.
-        # We can cache it and feed in true reward indeces instead of true_reward_matrix. The matrix multiplication has
-        # size_proxy x size_true x feature_dim complexity. The other calculations in this map have a factor feature_dim
-        # less. However, storing this matrix takes size_proxy / feature_dim more memory. That's good for large feature_dim.
+        # The matrix multiplication has size_proxy x size_true x feature_dim complexity. The other calculations in this
+        # map have a factor feature_dim less. For discrete queries, Inference.cache_log_likelihoods stores the result
+        # for the whole proxy space so that it can be fed in via log_likelihoods instead of being recomputed here.
+        # Storing it takes size_proxy / feature_dim more memory than true_reward_matrix.
         self.avg_reward_matrix = tf.tensordot(
             self.feature_expectations, self.true_reward_matrix, axes=[-1, -1], name='avg_reward_matrix')
 
+        # Can be fed directly (e.g. rows gathered from Inference.log_likelihood_matrix) to skip the matrix product.
         log_likelihoods_new = self.beta * self.avg_reward_matrix
+        self.log_likelihoods = log_likelihoods_new
 
         # Calculate posterior
-        # self.prior = tf.compat.v1.placeholder(tf.float32, name="prior", shape=(true_reward_space_size))
-        self.log_prior = tf.compat.v1.placeholder(tf.float32, name="log_prior", shape=(true_reward_space_size))
-        log_Z_w = tf.reduce_logsumexp(log_likelihoods_new, axis=0, name='log_Z_w')
+        log_Z_w = tf.reduce_logsumexp(log_likelihoods_new, axis=-2, name='log_Z_w', keepdims=True)
         log_P_q_z = log_likelihoods_new - log_Z_w  # broadcasting
         # self.log_Z_q, max_a, max_b = logdot(log_P_q_z, tf.compat.v1.log(self.prior))
-        self.log_Z_q = tf.reduce_logsumexp(log_P_q_z + self.log_prior, axis=1, name='log_Z_q', keepdims=True)
+        self.log_Z_q = tf.reduce_logsumexp(log_P_q_z + self.log_prior, axis=-1, name='log_Z_q', keepdims=True)
         # TODO: For BALD objective, just take entropy of Z_q - prior expected entropy of q
         # self.log_posterior = log_P_q_z + tf.compat.v1.log(self.prior) - self.log_Z_q
         self.log_posterior = log_P_q_z + self.log_prior - self.log_Z_q  # 2x broadcasting
         self.posterior = tf.exp(self.log_posterior, name="posterior")
 
-        self.post_sum_to_1 = tf.reduce_sum(tf.exp(self.log_posterior), axis=1, name='post_sum_to_1')
+        self.post_sum_to_1 = tf.reduce_sum(tf.exp(self.log_posterior), axis=-1, name='post_sum_to_1')
+
+        self.name_to_op['avg_reward_matrix'] = self.avg_reward_matrix
+        self.name_to_op['log_likelihoods'] = self.log_likelihoods
+        self.name_to_op['posterior'] = self.posterior
+        self.name_to_op['log_posterior'] = self.log_posterior
+        self.name_to_op['post_sum_to_1'] = self.post_sum_to_1
+
+    def build_chunked_log_posterior(self):
+        """
+        Computes the same normalizers and entropies as build_log_posterior, but walks the true reward space in blocks
+        of args.posterior_block_size and combines partial logsumexps. Peak memory is K x block size instead of
+        K x size_true, but the K x size_true posterior itself is not available.
+        """
+        self.build_belief_inputs()
+        block_size = self.args.posterior_block_size
+        num_true = tf.shape(self.true_reward_matrix)[0]
+        num_blocks = (num_true + block_size - 1) // block_size
+        K = tf.shape(self.feature_expectations)[0]
+
+        def get_block_log_joint(i):
+            """Returns log P(answer | true reward) + log prior for the true rewards in block i."""
+            start = i * block_size
+            true_rewards = self.true_reward_matrix[start:start + block_size]
+            log_likelihoods = self.beta * tf.tensordot(self.feature_expectations, true_rewards, axes=[-1, -1])
+            log_P_q_z = log_likelihoods - tf.reduce_logsumexp(log_likelihoods, axis=0, keepdims=True)
+            return log_P_q_z + self.log_prior[start:start + block_size]
+
+        def reduce_logsumexp_over_blocks(get_block_value, name):
+            """Computes the logsumexp over all blocks of get_block_value(i), which is reduced over true rewards."""
+
+            def body(i, acc):
+                return i + 1, tf.reduce_logsumexp(tf.stack([acc, get_block_value(i)]), axis=0)
+
+            initial = tf.fill([K, 1], float('-inf'))
+            _, result = tf.while_loop(
+                lambda i, acc: i < num_blocks, body, [tf.constant(0), initial], parallel_iterations=1, name=name)
+            return result
+
+        self.log_Z_q = reduce_logsumexp_over_blocks(
+            lambda i: tf.reduce_logsumexp(get_block_log_joint(i), axis=1, keepdims=True), 'log_Z_q')
+
+        def get_block_log_entropy(i):
+            scaled_log_posterior = get_block_log_joint(i) - self.log_Z_q - 0.0001
+            interm_tensor = scaled_log_posterior + tf.compat.v1.log(- scaled_log_posterior)
+            return tf.reduce_logsumexp(interm_tensor, axis=1, keepdims=True)
+
+        # Entropy of the posterior for every answer (used by the entropy objective)
+        self.log_post_ent_new = reduce_logsumexp_over_blocks(get_block_log_entropy, 'log_entropy_per_answer')
+
+        def get_log_posterior_for_answer(answer):
+            def body(i, log_posteriors):
+                log_posterior = get_block_log_joint(i)[answer] - self.log_Z_q[answer]
+                return i + 1, log_posteriors.write(i, log_posterior)
+
+            log_posteriors = tf.TensorArray(tf.float32, size=num_blocks, infer_shape=False)
+            _, log_posteriors = tf.while_loop(
+                lambda i, _: i < num_blocks, body, [tf.constant(0), log_posteriors], parallel_iterations=1)
+            return log_posteriors.concat()
+
+        self.get_log_posterior_for_answer = get_log_posterior_for_answer
+
+    def get_log_posterior_for_answer(self, answer):
+        """Returns the log posterior over true rewards after the given answer."""
+        return self.log_posterior[answer]
+
+    def build_true_posterior(self):
+        """
+        Samples an answer from the true reward and maps it to self.true_log_posterior and the posterior average.
+        """
+        dim = self.feature_dim
 
         # Get log likelihoods for actual true reward
         self.true_reward = tf.compat.v1.placeholder(
@@ -178,8 +329,8 @@ class Model(object):
         self.log_true_answer_probs = tf.reshape(self.log_true_answer_probs, shape=[1, -1])
         sample = tf.compat.v1.multinomial(self.log_true_answer_probs, num_samples=1)
         sample = sample[0][0]
-        self.true_log_posterior = self.log_posterior[sample]
-        self.true_posterior = self.posterior[sample]
+        self.true_log_posterior = self.get_log_posterior_for_answer(sample)
+        self.true_posterior = tf.exp(self.true_log_posterior)
 
         self.name_to_op['sample'] = sample
         self.name_to_op['true_posterior'] = self.true_posterior
@@ -207,13 +358,6 @@ class Model(object):
 
         # Fill name to ops dict
         self.name_to_op['post_avg'] = self.true_post_avg
-        self.name_to_op['avg_reward_matrix'] = self.avg_reward_matrix
-        self.name_to_op['true_reward_matrix'] = self.true_reward_matrix
-        # self.name_to_op['prior'] = self.prior
-        self.name_to_op['log_prior'] = self.log_prior
-        self.name_to_op['posterior'] = self.posterior
-        self.name_to_op['log_posterior'] = self.log_posterior
-        self.name_to_op['post_sum_to_1'] = self.post_sum_to_1
 
     def build_map_to_objective(self, objective):
         """
@@ -228,14 +372,15 @@ class Model(object):
             # self.name_to_op['entropy'] = self.exp_post_ent
 
             # Calculate entropy as exp logsumexp (log p + log (-log p))
-            scaled_log_posterior = self.log_posterior - 0.0001
-            interm_tensor = scaled_log_posterior + tf.compat.v1.log(- scaled_log_posterior)
-            self.log_post_ent_new = tf.reduce_logsumexp(
-                interm_tensor, axis=1, name="log_entropy_per_answer", keepdims=True)
+            if not self.chunked_posterior:
+                scaled_log_posterior = self.log_posterior - 0.0001
+                interm_tensor = scaled_log_posterior + tf.compat.v1.log(- scaled_log_posterior)
+                self.log_post_ent_new = tf.reduce_logsumexp(
+                    interm_tensor, axis=-1, name="log_entropy_per_answer", keepdims=True)
             self.post_ent_new = tf.exp(self.log_post_ent_new)
             self.name_to_op['entropy_per_answer'] = self.post_ent_new
             self.log_exp_post_ent = tf.reduce_logsumexp(
-                self.log_post_ent_new + self.log_Z_q, axis=0, keepdims=True, name='log_entropy')
+                self.log_post_ent_new + self.log_Z_q, axis=-2, keepdims=True, name='log_entropy')
             self.exp_post_ent = tf.exp(self.log_exp_post_ent)
             self.name_to_op['entropy'] = self.exp_post_ent
 
@@ -260,6 +405,8 @@ class Model(object):
                 self.objective = -self.query_entropy
 
         if 'total_variation' == objective:
+            if self.chunked_posterior:
+                raise ValueError('total_variation needs the full posterior, set posterior_block_size to 0')
 
             self.post_averages, self.post_var = tf.nn.weighted_moments(
                 self.true_reward_matrix, [1, 1], tf.stack([self.posterior] * self.feature_dim, axis=2),
@@ -295,8 +442,9 @@ class Model(object):
             self.name_to_op['lr_tensor'] = self.lr_tensor
 
     def compute(self, outputs, sess, mdp, query=None, log_prior=None, weight_inits=None,
-                feature_expectations_input=None,
-                gradient_steps=0, gradient_logging_outputs=[], true_reward=None, true_reward_matrix=None, lr=None):
+                feature_expectations_input=None, initial_feature_exps=None,
+                gradient_steps=0, gradient_logging_outputs=[], true_reward=None, true_reward_matrix=None, lr=None,
+                log_likelihoods=None):
         """
         Takes gradient steps to set the non-query features to the values that
         best optimize the objective. After optimization, calculates the values
@@ -307,7 +455,11 @@ class Model(object):
         :param mdp: The MDP whose true reward function we want to identify.
         :param query: List of features (integers) to ask the user to set.
         :param weight_inits: Initialization for the non-query features.
+        :param initial_feature_exps: Feature expectations of every state to start value iteration from, as returned
+        in all_feature_exps. Only for planners that use value iteration.
         :param gradient_steps: Number of gradient steps to take.
+        :param log_likelihoods: Precomputed K x size_true log likelihoods. If given, true_reward_matrix and the feature
+        expectations are not needed for the posterior over true rewards.
         :return: List of the same length as parameter `outputs`.
         """
         if weight_inits is not None:
@@ -318,9 +470,10 @@ class Model(object):
         self.update_feed_dict_with_mdp(mdp, fd)
         if feature_expectations_input is not None:
             fd[self.feature_expectations] = feature_expectations_input
+        if initial_feature_exps is not None:
+            fd[self.initial_feature_exps] = initial_feature_exps
 
-        if log_prior is not None:
-            fd[self.log_prior] = log_prior
+        self.update_feed_dict_with_belief(sess, fd, true_reward_matrix, log_prior)
 
         if query:
             if self.discrete and self.optimize:
@@ -332,8 +485,8 @@ class Model(object):
 
         if true_reward is not None:
             fd[self.true_reward] = true_reward
-        if true_reward_matrix is not None:
-            fd[self.true_reward_matrix] = true_reward_matrix
+        if log_likelihoods is not None:
+            fd[self.log_likelihoods] = log_likelihoods
 
         def get_op(name):
             if name not in self.name_to_op:
@@ -355,6 +508,16 @@ class Model(object):
     def update_feed_dict_with_mdp(self, mdp, fd):
         raise NotImplemented('Should be implemented in subclass')
 
+    def update_feed_dict_with_belief(self, sess, fd, true_reward_matrix, log_prior):
+        """Feeds the true reward matrix and log prior, or loads them into the resident belief if there is one."""
+        if self.resident_belief is not None:
+            self.resident_belief.load(sess, true_reward_matrix, log_prior)
+            return
+        if true_reward_matrix is not None:
+            fd[self.true_reward_matrix] = true_reward_matrix
+        if log_prior is not None:
+            fd[self.log_prior] = log_prior
+
     def get_permutation_from_query(self, query):
         dim = self.feature_dim
         # Running example: query = [1, 3], and we want indexes that will permute
@@ -381,10 +544,8 @@ class BanditsModel(Model):
             tf.float32, name="features", shape=[None, self.feature_dim])
         self.name_to_op['features'] = self.features
 
-        # Calculate state probabilities
-        weights_expand = tf.expand_dims(self.weights, axis=1)
-        intermediate_tensor = tf.multiply(tf.stack([self.features] * self.K, axis=0), weights_expand)
-        self.reward_per_state = tf.reduce_sum(intermediate_tensor, axis=-1, keepdims=False, name="rewards_per_state")
+        # Calculate state probabilities. Matrix products avoid K x states x dim intermediates.
+        self.reward_per_state = tf.matmul(self.weights, self.features, transpose_b=True, name="rewards_per_state")
         self.name_to_op['reward_per_state'] = self.reward_per_state
         self.name_to_op['q_values'] = self.reward_per_state
 
@@ -399,22 +560,85 @@ class BanditsModel(Model):
 
         self.name_to_op['state_probs'] = self.state_probs
         self.name_to_op['state_probs_cut'] = self.state_probs[:5]
-        """Changes: remove [0] from best state; remove reshape; stack probs on axis 2 (was 1); stack features on axis 1 (was 2); sum features on axis 1 (was 0); remove transpose."""
 
         # Calculate feature expectations
-        probs_stack = tf.stack([self.state_probs] * self.feature_dim, axis=2)
-        features_stack = tf.multiply(tf.stack([self.features] * self.K, axis=0), probs_stack, name='multi')
-        self.feature_expectations = tf.reduce_sum(features_stack, axis=1, keepdims=False, name="feature_exps")
+        self.feature_expectations = tf.matmul(self.state_probs, self.features, name="feature_exps")
         self.name_to_op['feature_exps'] = self.feature_expectations
 
     def update_feed_dict_with_mdp(self, mdp, fd):
         fd[self.features] = mdp.convert_to_numpy_input()
 
 
+class StreamingBanditsModel(BanditsModel):
+    """Bandits planner whose memory doesn't grow with the number of states (arms).
+
+    The MDP must be an NStateMdpStreamedGaussianFeatures. Its features are generated a block at a time inside a
+    symbolic loop, and the feature expectations are accumulated with an online softmax: a running maximum reward, the
+    sum of exponentiated rewards and the exponentiated-reward-weighted sum of features, all rescaled whenever the
+    maximum increases. Only the feature expectations are computed, not the K x states Q-values or state
+    probabilities.
+    """
+
+    def build_planner(self):
+        dim = self.feature_dim
+        self.feature_seed = tf.compat.v1.placeholder(tf.int64, name="feature_seed", shape=[])
+        self.num_states = tf.compat.v1.placeholder(tf.int64, name="num_states", shape=[])
+        self.block_size = tf.compat.v1.placeholder(tf.int64, name="block_size", shape=[])
+        num_blocks = (self.num_states + self.block_size - 1) // self.block_size
+        K = tf.shape(self.weights)[0]
+
+        def get_feature_block(block):
+            features = tf.numpy_function(
+                NStateMdpStreamedGaussianFeatures.generate_feature_block,
+                [self.feature_seed, block, self.block_size, self.num_states, tf.constant(dim, tf.int64)], tf.float32)
+            features.set_shape([None, dim])
+            return features
+
+        # Rational planner: keep the features of the best state so far. Ties go to the first state, like argmax.
+        if self.beta_planner == 'inf':
+            def body(block, best_rewards, best_features):
+                features = get_feature_block(block)
+                rewards = tf.matmul(self.weights, features, transpose_b=True)
+                block_best_rewards = tf.reduce_max(rewards, axis=1)
+                block_best_features = tf.gather(features, tf.argmax(rewards, axis=1))
+                is_better = tf.expand_dims(block_best_rewards > best_rewards, 1)
+                return (block + 1, tf.maximum(best_rewards, block_best_rewards),
+                        tf.where(is_better, block_best_features, best_features))
+
+            _, _, self.feature_expectations = tf.while_loop(
+                lambda block, *_: block < num_blocks, body,
+                [tf.constant(0, tf.int64), tf.fill([K], -np.inf), tf.zeros([K, dim])], name='streaming_planner')
+        # Boltzmann rational planner
+        else:
+            def body(block, max_rewards, normalizer, weighted_features):
+                features = get_feature_block(block)
+                rewards = self.beta_planner * tf.matmul(self.weights, features, transpose_b=True)
+                new_max_rewards = tf.maximum(max_rewards, tf.reduce_max(rewards, axis=1))
+                rescale = tf.exp(max_rewards - new_max_rewards)
+                unnormalized_probs = tf.exp(rewards - tf.expand_dims(new_max_rewards, 1))
+                normalizer = normalizer * rescale + tf.reduce_sum(unnormalized_probs, axis=1)
+                weighted_features = (weighted_features * tf.expand_dims(rescale, 1)
+                                     + tf.matmul(unnormalized_probs, features))
+                return block + 1, new_max_rewards, normalizer, weighted_features
+
+            _, _, normalizer, weighted_features = tf.while_loop(
+                lambda block, *_: block < num_blocks, body,
+                [tf.constant(0, tf.int64), tf.fill([K], -np.inf), tf.zeros([K]), tf.zeros([K, dim])],
+                name='streaming_planner')
+            self.feature_expectations = weighted_features / tf.expand_dims(normalizer, 1)
+        self.name_to_op['feature_exps'] = self.feature_expectations
+
+    def update_feed_dict_with_mdp(self, mdp, fd):
+        seed, num_states, block_size = mdp.convert_to_streamed_input()
+        fd[self.feature_seed] = seed
+        fd[self.num_states] = num_states
+        fd[self.block_size] = block_size
+
+
 class GridworldModel(Model):
     def __init__(self, feature_dim, gamma, query_size, discretization_const,
                  true_reward_space_size, num_unknown, beta, beta_planner,
-                 objective, lr, discrete, optimize, height, width, num_iters, args):
+                 objective, lr, discrete, optimize, height, width, num_iters, args, resident_belief=None):
         self.height = height
         self.width = width
         self.num_iters = num_iters
@@ -422,64 +646,110 @@ class GridworldModel(Model):
         super(GridworldModel, self).__init__(
             feature_dim, gamma, query_size, discretization_const,
             true_reward_space_size, num_unknown, beta, beta_planner,
-            objective, lr, discrete, optimize, args)
+            objective, lr, discrete, optimize, args, resident_belief)
 
     def build_planner(self):
-        height, width, dim = self.height, self.width, self.feature_dim
-        num_actions, K = self.num_actions, self.K
+        dim = self.feature_dim
 
-        self.image = tf.compat.v1.placeholder(
-            tf.float32, name="image", shape=[height, width])
-        self.features = tf.compat.v1.placeholder(
-            tf.float32, name="features", shape=[height, width, dim])
-        self.start_x = tf.compat.v1.placeholder(tf.int32, name="start_x", shape=[])
-        self.start_y = tf.compat.v1.placeholder(tf.int32, name="start_y", shape=[])
+        self.build_mdp_inputs()
+        height, width = tf.shape(self.image)[-2], tf.shape(self.image)[-1]
+        K = tf.shape(self.weights)[0]
 
+        # Height by width by dim + 1, shared by all K queried rewards through broadcasting (or one per reward when
+        # batching gridworlds)
         features_wall = tf.concat(
             [self.features, tf.expand_dims(self.image, -1)], axis=-1)
-        features_wall = tf.stack([features_wall] * K, axis=0)
-        wall_constant = [[-1000000.0] for _ in range(K)]
+        wall_constant = tf.fill([K, 1], -1000000.0)
+        # K by dim + 1
         weights_wall = tf.concat([self.weights, wall_constant], axis=-1)
-        # Change from K by dim to K by 1 by dim
-        weights_wall = tf.expand_dims(weights_wall, axis=1)
-        # Change to K by height by width by 1 by dim
-        weights_wall = tf.stack([weights_wall] * width, axis=1)
-        weights_wall = tf.stack([weights_wall] * height, axis=1)
         dim += 1
 
-        feature_expectations = tf.zeros([K, height, width, dim])
-        for i in range(self.num_iters):
-            q_fes = self.bellman_update(feature_expectations, features_wall)
-            q_values = tf.squeeze(tf.matmul(weights_wall, q_fes), [-2])
-            if self.beta_planner == 'inf':
-                best_actions = tf.argmax(q_values, axis=-1)
-                policy = tf.one_hot(best_actions[0], 4)
-            else:
-                policy = tf.nn.softmax(self.beta_planner * q_values)
-            repeated_policy = tf.stack([policy] * dim, axis=-2)
-            feature_expectations = tf.reduce_sum(
-                tf.multiply(repeated_policy, q_fes), axis=-1)
-            self.name_to_op['policy' + str(i)] = policy
+        feature_expectations = self.build_value_iteration(
+            self.build_initial_feature_exps([K, height, width, dim]), features_wall, weights_wall)
+        self.name_to_op['all_feature_exps'] = feature_expectations
 
         # Remove the wall feature
         self.feature_expectations_grid = feature_expectations[:, :, :, :-1]
         dim -= 1
         self.name_to_op['feature_exps_grid'] = self.feature_expectations_grid
 
-        x, y = self.start_x, self.start_y
-        self.feature_expectations = self.feature_expectations_grid[:, y, x, :]
+        self.feature_expectations = self.get_start_feature_exps(self.feature_expectations_grid)
         self.name_to_op['feature_exps'] = self.feature_expectations
 
         q_fes = self.bellman_update(feature_expectations, features_wall)
-        q_values = tf.squeeze(tf.matmul(weights_wall, q_fes), [-2])
+        q_values = self.get_q_values(weights_wall, q_fes)
         self.q_values = q_values
         self.name_to_op['q_values'] = q_values
 
+    def build_mdp_inputs(self):
+        # The height, width and number of queried rewards K are only known when the graph is run
+        self.image = tf.compat.v1.placeholder(
+            tf.float32, name="image", shape=[None, None])
+        self.features = tf.compat.v1.placeholder(
+            tf.float32, name="features", shape=[None, None, self.feature_dim])
+        self.start_x = tf.compat.v1.placeholder(tf.int32, name="start_x", shape=[])
+        self.start_y = tf.compat.v1.placeholder(tf.int32, name="start_y", shape=[])
+
+    def get_start_feature_exps(self, fes_grid):
+        """Returns the K by dim feature expectations of the start state."""
+        return fes_grid[:, self.start_y, self.start_x, :]
+
+    def build_initial_feature_exps(self, shape):
+        """Returns the feature expectations of every state that value iteration starts from. These are zeros unless
+        initial_feature_exps is fed, e.g. with the all_feature_exps of a previous solution to warm start.
+
+        Without convergence, value iteration plans num_iters steps ahead, and starting from earlier feature expectations
+        adds num_iters steps to the horizon of those. Only warm start from solutions that converged with gamma < 1."""
+        self.initial_feature_exps = tf.compat.v1.placeholder_with_default(
+            tf.zeros(shape), shape=[None] * (len(shape) - 1) + [shape[-1]], name='initial_feature_exps')
+        return self.initial_feature_exps
+
+    def build_value_iteration(self, fes, features, weights):
+        """Runs value iteration from the feature expectations fes and returns the result. A symbolic loop keeps the
+        graph size independent of num_iters. With a tolerance, stop once the feature expectations change by at most
+        tolerance."""
+        tolerance = self.args.value_iter_tolerance
+
+        def cond(i, fes, max_change):
+            if tolerance > 0:
+                return tf.logical_and(i < self.num_iters, max_change > tolerance)
+            return i < self.num_iters
+
+        def body(i, fes, max_change):
+            new_fes, _ = self.value_iteration_step(fes, features, weights)
+            return i + 1, new_fes, tf.reduce_max(tf.abs(new_fes - fes))
+
+        self.num_value_iters, fes, self.value_iter_change = tf.while_loop(
+            cond, body, [tf.constant(0), fes, tf.constant(float('inf'))], name='value_iteration')
+        self.name_to_op['num_value_iters'] = self.num_value_iters
+        # Largest change in the last iteration. Value iteration converged if it is at most the tolerance.
+        self.name_to_op['value_iter_change'] = self.value_iter_change
+        return fes
+
+    def value_iteration_step(self, fes, features, weights):
+        """Does one Bellman update of the feature expectations under the (Boltzmann) rational policy for the weights.
+        Returns the new feature expectations and the policy."""
+        q_fes = self.bellman_update(fes, features)
+        q_values = self.get_q_values(weights, q_fes)
+        if self.beta_planner == 'inf':
+            best_actions = tf.argmax(q_values, axis=-1)
+            policy = tf.one_hot(best_actions, 4)
+        else:
+            policy = tf.nn.softmax(self.beta_planner * q_values)
+        # Accumulate one action at a time instead of materializing a K x states x dim x 4 tensor
+        new_fes = tf.add_n([policy[..., a:a + 1] * action_fes for a, action_fes in enumerate(q_fes)])
+        return new_fes, policy
+
+    def get_q_values(self, weights, q_fes):
+        """Maps the K by dim weights and the feature expectations of each action to K x height x width x 4 Q-values."""
+        return tf.stack([tf.einsum('khwd,kd->khw', action_fes, weights) for action_fes in q_fes], axis=-1)
+
     def bellman_update(self, fes, features):
-        height, width, dim = self.height, self.width, self.feature_dim + 1
-        gamma, K = self.gamma, self.K
-        extra_row = tf.zeros((K, 1, width, dim))
-        extra_col = tf.zeros((K, height, 1, dim))
+        """Returns the K x height x width x dim feature expectations of moving north, south, east and west, given the
+        feature expectations fes of every state and the height x width x dim features."""
+        gamma = self.gamma
+        extra_row = tf.zeros_like(fes[:, :1])
+        extra_col = tf.zeros_like(fes[:, :, :1])
 
         north_lookahead = tf.concat([extra_row, fes[:, :-1]], axis=1)
         north_fes = features + gamma * north_lookahead
@@ -489,7 +759,7 @@ class GridworldModel(Model):
         east_fes = features + gamma * east_lookahead
         west_lookahead = tf.concat([extra_col, fes[:, :, :-1]], axis=2)
         west_fes = features + gamma * west_lookahead
-        return tf.stack([north_fes, south_fes, east_fes, west_fes], axis=-1)
+        return [north_fes, south_fes, east_fes, west_fes]
 
     def update_feed_dict_with_mdp(self, mdp, fd):
         image, features, start_state = mdp.convert_to_numpy_input()
@@ -500,6 +770,152 @@ class GridworldModel(Model):
         fd[self.start_y] = y
 
 
+class BatchedGridworldModel(GridworldModel):
+    """Plans in a different gridworld for every queried reward, so that many MDPs are solved in one evaluation.
+
+    The mdp given to compute is a list of K gridworlds of the same height and width, where the k-th gridworld is
+    planned in with the k-th row of the weights. Feature expectations are computed like in GridworldModel.
+    """
+
+    def build_mdp_inputs(self):
+        self.image = tf.compat.v1.placeholder(
+            tf.float32, name="image", shape=[None, None, None])
+        self.features = tf.compat.v1.placeholder(
+            tf.float32, name="features", shape=[None, None, None, self.feature_dim])
+        self.start_x = tf.compat.v1.placeholder(tf.int32, name="start_x", shape=[None])
+        self.start_y = tf.compat.v1.placeholder(tf.int32, name="start_y", shape=[None])
+
+    def get_start_feature_exps(self, fes_grid):
+        K = tf.shape(fes_grid)[0]
+        return tf.gather_nd(fes_grid, tf.stack([tf.range(K), self.start_y, self.start_x], axis=1))
+
+    def update_feed_dict_with_mdp(self, mdps, fd):
+        images, features, start_states = zip(*[mdp.convert_to_numpy_input() for mdp in mdps])
+        fd[self.image] = np.stack(images)
+        fd[self.features] = np.stack(features)
+        fd[self.start_x] = [x for x, y in start_states]
+        fd[self.start_y] = [y for x, y in start_states]
+
+
+class SparseGridworldModel(GridworldModel):
+    """Plans only over the states that aren't walls, as given by GridworldMdp.convert_to_sparse_numpy_input.
+
+    Bellman backups gather the feature expectations of each state's neighbours, and moves into walls are masked out
+    of the policy. For grids surrounded by walls, gives the same feature expectations as GridworldModel for every
+    state that isn't enclosed by walls, without computing anything for wall cells.
+    """
+
+    def build_planner(self):
+        dim = self.feature_dim
+
+        self.state_features = tf.compat.v1.placeholder(
+            tf.float32, name="state_features", shape=[None, dim])
+        # Index of the state reached by each action. Moves into walls lead to an extra state with no features.
+        self.neighbors = tf.compat.v1.placeholder(tf.int32, name="neighbors", shape=[None, 4])
+        self.valid_actions = tf.compat.v1.placeholder(tf.float32, name="valid_actions", shape=[None, 4])
+        self.start_index = tf.compat.v1.placeholder(tf.int32, name="start_index", shape=[])
+        num_states = tf.shape(self.state_features)[0]
+        K = tf.shape(self.weights)[0]
+
+        self.feature_expectations_states = self.build_value_iteration(
+            self.build_initial_feature_exps([K, num_states, dim]), self.state_features, self.weights)
+        self.name_to_op['feature_exps_states'] = self.feature_expectations_states
+        self.name_to_op['all_feature_exps'] = self.feature_expectations_states
+
+        self.feature_expectations = self.feature_expectations_states[:, self.start_index, :]
+        self.name_to_op['feature_exps'] = self.feature_expectations
+
+        q_fes = self.bellman_update(self.feature_expectations_states, self.state_features)
+        self.q_values = self.get_q_values(self.weights, q_fes)
+        self.name_to_op['q_values'] = self.q_values
+
+    def get_q_values(self, weights, q_fes):
+        """Maps the K by dim weights and the feature expectations of each action to K x states x 4 Q-values."""
+        q_values = tf.stack([tf.einsum('ksd,kd->ks', action_fes, weights) for action_fes in q_fes], axis=-1)
+        # Like the wall feature of GridworldModel, makes the policy never move into walls
+        return q_values - 1000000.0 * (1 - self.valid_actions)
+
+    def bellman_update(self, fes, features):
+        """Returns the K x states x dim feature expectations of moving north, south, east and west."""
+        padded_fes = tf.concat([fes, tf.zeros_like(fes[:, :1])], axis=1)
+        return [features + self.gamma * tf.gather(padded_fes, self.neighbors[:, a], axis=1) for a in range(4)]
+
+    def update_feed_dict_with_mdp(self, mdp, fd):
+        state_features, neighbors, valid_actions, start_index = mdp.convert_to_sparse_numpy_input()
+        fd[self.state_features] = state_features
+        fd[self.neighbors] = neighbors
+        fd[self.valid_actions] = valid_actions
+        fd[self.start_index] = start_index
+
+
+class TabularModel(GridworldModel):
+    """Plans in any MDP from the arrays of its TabularMdp, using the value iteration of GridworldModel.
+
+    Bellman backups multiply the sparse (states * actions) x states transition matrix with the feature expectations
+    of every state, so they cost time proportional to the number of nonzero transitions. Stochastic transitions
+    (such as gridworlds with noise) are supported. Gets the same feature expectations as SparseGridworldModel for
+    deterministic gridworlds. Like GridworldModel it plans num_iters steps ahead, so it is not meant for bandits,
+    where the agent makes a single choice.
+    """
+
+    def build_planner(self):
+        dim = self.feature_dim
+
+        self.state_features = tf.compat.v1.placeholder(
+            tf.float32, name="state_features", shape=[None, dim])
+        self.transitions = tf.compat.v1.sparse_placeholder(tf.float32, name="transitions", shape=[None, None])
+        self.action_mask = tf.compat.v1.placeholder(tf.float32, name="action_mask", shape=[None, None])
+        self.start_index = tf.compat.v1.placeholder(tf.int32, name="start_index", shape=[])
+        num_states = tf.shape(self.state_features)[0]
+        K = tf.shape(self.weights)[0]
+
+        self.feature_expectations_states = self.build_value_iteration(
+            self.build_initial_feature_exps([K, num_states, dim]), self.state_features, self.weights)
+        self.name_to_op['feature_exps_states'] = self.feature_expectations_states
+        self.name_to_op['all_feature_exps'] = self.feature_expectations_states
+
+        self.feature_expectations = self.feature_expectations_states[:, self.start_index, :]
+        self.name_to_op['feature_exps'] = self.feature_expectations
+
+        q_fes = self.bellman_update(self.feature_expectations_states, self.state_features)
+        self.q_values = self.get_q_values(self.weights, q_fes)
+        self.name_to_op['q_values'] = self.q_values
+
+    def value_iteration_step(self, fes, features, weights):
+        q_fes = self.bellman_update(fes, features)
+        q_values = self.get_q_values(weights, q_fes)
+        if self.beta_planner == 'inf':
+            best_actions = tf.argmax(q_values, axis=-1)
+            policy = tf.one_hot(best_actions, tf.shape(self.action_mask)[1])
+        else:
+            policy = tf.nn.softmax(self.beta_planner * q_values)
+        new_fes = tf.einsum('ksa,ksad->ksd', policy, q_fes)
+        return new_fes, policy
+
+    def get_q_values(self, weights, q_fes):
+        """Maps the K by dim weights and the K x states x actions x dim feature expectations to Q-values."""
+        q_values = tf.einsum('ksad,kd->ksa', q_fes, weights)
+        # Makes the policy never take actions that aren't available
+        return q_values - 1000000.0 * (1 - self.action_mask)
+
+    def bellman_update(self, fes, features):
+        """Returns the K x states x actions x dim feature expectations of taking each action in each state."""
+        K, num_states, dim = tf.shape(fes)[0], tf.shape(fes)[1], tf.shape(fes)[2]
+        num_actions = tf.shape(self.action_mask)[1]
+        # One sparse product for all K: states x (K * dim) in, (states * actions) x (K * dim) out
+        fes_by_state = tf.reshape(tf.transpose(fes, [1, 0, 2]), [num_states, K * dim])
+        lookahead = tf.sparse.sparse_dense_matmul(self.transitions, fes_by_state)
+        lookahead = tf.transpose(tf.reshape(lookahead, [num_states, num_actions, K, dim]), [2, 0, 1, 3])
+        return tf.expand_dims(features, 1) + self.gamma * lookahead
+
+    def update_feed_dict_with_mdp(self, mdp, fd):
+        tabular_mdp = mdp.convert_to_tabular_input()
+        fd[self.state_features] = tabular_mdp.features
+        fd[self.transitions] = tf.compat.v1.SparseTensorValue(*tabular_mdp.get_sparse_transitions())
+        fd[self.action_mask] = tabular_mdp.action_mask
+        fd[self.start_index] = tabular_mdp.start_index
+
+
 class NoPlanningModel(Model):
 
     def build_weights(self):
@@ -507,8 +923,70 @@ class NoPlanningModel(Model):
 
     def build_planner(self):
         self.feature_expectations = tf.compat.v1.placeholder(
-            tf.float32, shape=[self.K, self.feature_dim], name='feature_exps')
+            tf.float32, shape=[None, self.feature_dim], name='feature_exps')
         self.name_to_op['feature_exps'] = self.feature_expectations
 
     def update_feed_dict_with_mdp(self, mdp, fd):
         pass
+
+
+class BatchedNoPlanningModel(NoPlanningModel):
+    """Scores many discrete queries of the same size in a single evaluation.
+
+    The feature expectations have shape [num_queries, K, dim] and are gathered from the feature expectations of the
+    whole proxy space using an index tensor of shape [num_queries, K]. Only the objective is computed, not the
+    posterior for a sampled answer.
+    """
+
+    def build_planner(self):
+        self.proxy_feature_exps = tf.compat.v1.placeholder(
+            tf.float32, shape=[None, self.feature_dim], name='proxy_feature_exps')
+        self.query_idx = tf.compat.v1.placeholder(tf.int32, shape=[None, None], name='query_idx')
+        self.feature_expectations = tf.gather(self.proxy_feature_exps, self.query_idx, name='feature_exps')
+        self.name_to_op['feature_exps'] = self.feature_expectations
+
+    def build_map_to_posterior(self):
+        self.chunked_posterior = False
+        self.build_log_posterior()
+
+    def build_map_to_objective(self, objective):
+        if objective not in ['entropy', 'query_neg_entropy']:
+            raise ValueError('Objective not supported for batched queries: ' + str(objective))
+        super(BatchedNoPlanningModel, self).build_map_to_objective(objective)
+
+    def compute_batch(self, outputs, sess, query_idx, log_prior, proxy_feature_exps=None, true_reward_matrix=None,
+                      proxy_log_likelihoods=None, max_megabytes=500):
+        """
+        Computes outputs for every query in query_idx, splitting the queries into chunks that fit into memory.
+
+        :param query_idx: Array of shape [num_queries, K] with indices into the proxy space.
+        :param proxy_feature_exps: Feature expectations of the proxy space. Requires true_reward_matrix.
+        :param proxy_log_likelihoods: Alternatively, log likelihoods of the proxy space for every true reward, e.g.
+        from Inference.get_log_likelihoods.
+        :param max_megabytes: Rough memory budget for the posterior tensors of one chunk.
+        :return: List of the same length as outputs, each concatenated over all queries.
+        """
+        query_idx = np.asarray(query_idx)
+        num_true = len(log_prior)
+        # Several tensors of shape [chunk_size, K, num_true] are alive at once
+        bytes_per_query = 8 * query_idx.shape[1] * num_true * 4
+        chunk_size = max(1, int(max_megabytes * 1e6 // bytes_per_query))
+
+        fd = {}
+        if proxy_log_likelihoods is None:
+            fd[self.proxy_feature_exps] = proxy_feature_exps
+            self.update_feed_dict_with_belief(sess, fd, true_reward_matrix, log_prior)
+        else:
+            self.update_feed_dict_with_belief(sess, fd, None, log_prior)
+
+        ops = [self.name_to_op[name] for name in outputs]
+        results = [[] for _ in outputs]
+        for start in range(0, len(query_idx), chunk_size):
+            idx = query_idx[start:start + chunk_size]
+            if proxy_log_likelihoods is None:
+                fd[self.query_idx] = idx
+            else:
+                fd[self.log_likelihoods] = proxy_log_likelihoods[idx]
+            for result, value in zip(results, sess.run(ops, feed_dict=fd)):
+                result.append(value)
+        return [np.concatenate(result, axis=0) for result in results]
@@ -1,19 +1,22 @@
+import argparse
 import random
 import unittest
 
 import numpy as np
 import tensorflow as tf
-from agents import ImmediateRewardAgent, OptimalAgent
 
 from gridworld import Direction
 from gridworld import GridworldMdp, GridworldMdpWithDistanceFeatures
 from gridworld import NStateMdpGaussianFeatures
-from planner import BanditsModel, GridworldModel
+from planner import (BanditsModel, BatchedGridworldModel, BatchedNoPlanningModel, GridworldModel, NoPlanningModel,
+                     ResidentBelief, SparseGridworldModel, TabularModel)
 
 
 class TestPlanner(unittest.TestCase):
 
     def test_gridworld_planner(self):
+        from agents import OptimalAgent
+
         def check_model_equivalent(model, query, weights, mdp, num_iters):
             with tf.compat.v1.Session() as sess:
                 sess.run(model.initialize_op)
@@ -54,6 +57,8 @@ class TestPlanner(unittest.TestCase):
         check_model_equivalent(model, query, other_weights, mdp, 25)
 
     def test_bandits_planner(self):
+        from agents import ImmediateRewardAgent
+
         def check_model_equivalent(model, query, weights, mdp, num_iters):
             with tf.compat.v1.Session() as sess:
                 sess.run(model.initialize_op)
@@ -90,5 +95,166 @@ class TestPlanner(unittest.TestCase):
         check_model_equivalent(model, query, other_weights, mdp, 20)
 
 
+def make_args(**kwargs):
+    """Returns the arguments that models and gridworlds read, with the defaults of run_IRD.py."""
+    args = dict(
+        feature_dim=4, repeated_obj=0, linear_features=1, log_objective=1, posterior_block_size=0,
+        support_tolerance=0, isolate_graphs=0, model_cache_size=0, model_cache_mb=0, resident_belief=1,
+        value_iter_tolerance=0, sparse_planner=0, tabular_planner=0, regret_batch_size=0, warm_start=0,
+        feature_block_size=0)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def random_belief(size_true, dim):
+    """Returns a random true reward matrix and a log prior over it."""
+    true_reward_matrix = np.random.randint(-9, 10, size=[size_true, dim]).astype(np.float32)
+    log_prior = 2 * np.random.randn(size_true)
+    return true_reward_matrix, (log_prior - np.log(np.exp(log_prior).sum())).astype(np.float32)
+
+
+class TestBatchedQueryScoring(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.dim = 4
+        self.beta = 0.5
+        tf.compat.v1.reset_default_graph()
+        self.sess = tf.compat.v1.Session()
+        self.args = make_args(feature_dim=self.dim)
+        self.proxy_feature_exps = np.random.rand(8, self.dim).astype(np.float32)
+        self.true_reward_matrix, self.log_prior = random_belief(50, self.dim)
+        self.query_idx = np.array([[0, 1], [2, 5], [7, 3], [4, 6], [1, 0]])
+
+    def tearDown(self):
+        self.sess.close()
+
+    def make_model(self, model_class, objective):
+        return model_class(self.dim, 0.9, 2, 5, None, None, self.beta, 0.5, objective, 0.1, True, False, self.args)
+
+    def test_batch_matches_single_queries(self):
+        for objective in ['entropy', 'query_neg_entropy']:
+            model = self.make_model(NoPlanningModel, objective)
+            batched_model = self.make_model(BatchedNoPlanningModel, objective)
+            expected = [model.compute([objective], self.sess, None, log_prior=self.log_prior,
+                                      feature_expectations_input=self.proxy_feature_exps[idx],
+                                      true_reward_matrix=self.true_reward_matrix)[0] for idx in self.query_idx]
+            # A tiny memory budget scores one query at a time
+            for max_megabytes in [500, 1e-6]:
+                [values] = batched_model.compute_batch(
+                    [objective], self.sess, self.query_idx, self.log_prior, proxy_feature_exps=self.proxy_feature_exps,
+                    true_reward_matrix=self.true_reward_matrix, max_megabytes=max_megabytes)
+                np.testing.assert_allclose(values.ravel(), np.ravel(expected), rtol=1e-5)
+
+    def test_batch_from_log_likelihoods(self):
+        model = self.make_model(BatchedNoPlanningModel, 'entropy')
+        proxy_log_likelihoods = self.beta * np.dot(self.proxy_feature_exps, self.true_reward_matrix.T)
+        [expected] = model.compute_batch(['entropy'], self.sess, self.query_idx, self.log_prior,
+                                         proxy_feature_exps=self.proxy_feature_exps,
+                                         true_reward_matrix=self.true_reward_matrix)
+        [values] = model.compute_batch(['entropy'], self.sess, self.query_idx, self.log_prior,
+                                       proxy_log_likelihoods=proxy_log_likelihoods)
+        np.testing.assert_allclose(values, expected, rtol=1e-5)
+
+
+class TestPlannerVariants(unittest.TestCase):
+    """Checks that the planners for large experiments plan like the dense GridworldModel on a small gridworld."""
+
+    def setUp(self):
+        np.random.seed(1)
+        random.seed(1)
+        self.dim = 4
+        self.gamma = 0.9
+        tf.compat.v1.reset_default_graph()
+        self.sess = tf.compat.v1.Session()
+        self.args = make_args(feature_dim=self.dim)
+        self.mdp = self.make_mdp(self.args)
+        self.weights = list(np.random.randint(-9, 10, size=[3, self.dim]).astype(float))
+        self.true_reward_matrix, self.log_prior = random_belief(50, self.dim)
+
+    def tearDown(self):
+        self.sess.close()
+
+    def make_mdp(self, args):
+        grid, goals = GridworldMdp.generate_random(args, 6, 7, 0.35, self.dim, None, living_reward=-0.01)
+        return GridworldMdpWithDistanceFeatures(grid, goals, args, 0.5, living_reward=-0.01)
+
+    def make_model(self, model_class, args, num_iters=20, resident_belief=None):
+        return model_class(self.dim, self.gamma, 2, 5, None, None, 0.5, 0.5, 'entropy', 0.1, True, False, 0, 0,
+                           num_iters, args, resident_belief)
+
+    def plan(self, model, mdp=None, weights=None, **kwargs):
+        mdp = self.mdp if mdp is None else mdp
+        weights = self.weights if weights is None else weights
+        return model.compute(['feature_exps'], self.sess, mdp, weights, **kwargs)[0]
+
+    def compute_posterior(self, model, log_prior):
+        """Returns the expected entropy, the entropy for every answer and the log posterior for the second answer."""
+        model.name_to_op['log_posterior_for_answer'] = model.get_log_posterior_for_answer(1)
+        return model.compute(['entropy', 'entropy_per_answer', 'log_posterior_for_answer'], self.sess, self.mdp,
+                             self.weights, log_prior=log_prior, true_reward_matrix=self.true_reward_matrix)
+
+    def check_posterior_matches_dense(self, model):
+        dense_model = self.make_model(GridworldModel, self.args)
+        _, new_log_prior = random_belief(50, self.dim)
+        # The second log prior checks that a resident belief is replaced
+        for log_prior in [self.log_prior, new_log_prior]:
+            for value, expected in zip(self.compute_posterior(model, log_prior),
+                                       self.compute_posterior(dense_model, log_prior)):
+                np.testing.assert_allclose(value, expected, rtol=1e-4, atol=1e-5)
+
+    def test_resident_belief(self):
+        self.check_posterior_matches_dense(
+            self.make_model(GridworldModel, self.args, resident_belief=ResidentBelief(self.dim)))
+
+    def test_chunked_posterior(self):
+        # Blocks that don't divide the 50 true rewards
+        args = make_args(feature_dim=self.dim, posterior_block_size=7)
+        self.check_posterior_matches_dense(self.make_model(GridworldModel, args))
+
+    def test_value_iteration_tolerance(self):
+        tolerance = 1e-5
+        model = self.make_model(GridworldModel, self.args, num_iters=300)
+        early_stopping_model = self.make_model(
+            GridworldModel, make_args(feature_dim=self.dim, value_iter_tolerance=tolerance), num_iters=300)
+        feature_exps, num_iters = early_stopping_model.compute(
+            ['feature_exps', 'num_value_iters'], self.sess, self.mdp, self.weights)
+        self.assertLess(num_iters, 300)
+        np.testing.assert_allclose(feature_exps, self.plan(model), atol=2 * tolerance / (1 - self.gamma))
+
+    def test_sparse_planner(self):
+        expected = self.plan(self.make_model(GridworldModel, self.args))
+        np.testing.assert_allclose(self.plan(self.make_model(SparseGridworldModel, self.args)), expected,
+                                   rtol=1e-4, atol=1e-5)
+
+    def test_tabular_planner(self):
+        expected = self.plan(self.make_model(GridworldModel, self.args))
+        np.testing.assert_allclose(self.plan(self.make_model(TabularModel, self.args)), expected,
+                                   rtol=1e-4, atol=1e-5)
+
+    def test_batched_planner(self):
+        other_mdp = self.make_mdp(self.args)
+        model = self.make_model(GridworldModel, self.args)
+        # Every weight is planned with in both gridworlds
+        mdps = [self.mdp] * len(self.weights) + [other_mdp] * len(self.weights)
+        feature_exps = self.plan(self.make_model(BatchedGridworldModel, self.args), mdps, self.weights * 2)
+        expected = np.concatenate([self.plan(model, self.mdp), self.plan(model, other_mdp)])
+        np.testing.assert_allclose(feature_exps, expected, rtol=1e-5, atol=1e-6)
+
+    def test_warm_start(self):
+        tolerance = 1e-4
+        args = make_args(feature_dim=self.dim, value_iter_tolerance=tolerance, warm_start=1)
+        model = self.make_model(GridworldModel, args, num_iters=500)
+        _, all_feature_exps, change = model.compute(
+            ['feature_exps', 'all_feature_exps', 'value_iter_change'], self.sess, self.mdp, self.weights)
+        self.assertLessEqual(change, tolerance)
+        new_weights = [w + 0.5 for w in self.weights]
+        (warm, num_iters), (cold, cold_num_iters) = [
+            model.compute(['feature_exps', 'num_value_iters'], self.sess, self.mdp, new_weights,
+                          initial_feature_exps=initial) for initial in [all_feature_exps, None]]
+        self.assertLess(num_iters, cold_num_iters)
+        # Both are within tolerance / (1 - gamma) of the fixed point
+        np.testing.assert_allclose(warm, cold, atol=2 * tolerance / (1 - self.gamma))
+
+
 if __name__ == '__main__':
     unittest.main()
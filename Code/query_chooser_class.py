@@ -2,6 +2,7 @@ import csv
 import datetime
 import os
 import time
+from collections import OrderedDict
 from itertools import combinations
 from random import choice, sample
 
@@ -9,7 +10,17 @@ import numpy as np
 import tensorflow as tf
 from scipy.special import comb
 
-from planner import BanditsModel, GridworldModel, NoPlanningModel
+from planner import (
+    BanditsModel,
+    BatchedGridworldModel,
+    BatchedNoPlanningModel,
+    GridworldModel,
+    NoPlanningModel,
+    ResidentBelief,
+    SparseGridworldModel,
+    StreamingBanditsModel,
+    TabularModel
+)
 
 
 def random_combination(iterable, r):
@@ -28,17 +39,88 @@ def time_function(function, input):
     return deltat
 
 
+class ModelCache(object):
+    """Least recently used cache of models with a cap on the number of models and on their size in memory.
+
+    Evicted models have their session closed if close_sessions is set. That only frees memory if every model has its
+    own graph and session.
+    """
+
+    def __init__(self, max_models=0, max_megabytes=0, close_sessions=False):
+        """
+        :param max_models: Maximum number of cached models, no limit if 0
+        :param max_megabytes: Maximum total size of the cached models, no limit if 0
+        """
+        self.max_models = max_models
+        self.max_megabytes = max_megabytes
+        self.close_sessions = close_sessions
+        self.models = OrderedDict()
+        self.megabytes = {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key):
+        """Returns the model for key and marks it as most recently used, or None if it isn't cached."""
+        if key not in self.models:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.models.move_to_end(key)
+        return self.models[key]
+
+    def add(self, key, model, megabytes=0):
+        self.models[key] = model
+        self.megabytes[key] = megabytes
+        # Never evict the model that was just added
+        while len(self.models) > 1 and self.is_full():
+            self.evict(next(iter(self.models)))
+
+    def is_full(self):
+        too_many = self.max_models and len(self.models) > self.max_models
+        too_big = self.max_megabytes and self.get_total_megabytes() > self.max_megabytes
+        return bool(too_many or too_big)
+
+    def evict(self, key):
+        model = self.models.pop(key)
+        del self.megabytes[key]
+        self.evictions += 1
+        if self.close_sessions:
+            model.sess.close()
+
+    def get_total_megabytes(self):
+        return sum(self.megabytes.values())
+
+    def __len__(self):
+        return len(self.models)
+
+    def __str__(self):
+        return '{n} models ({mb:.1f}MB), {hits} hits, {misses} misses, {evictions} evictions'.format(
+            n=len(self), mb=self.get_total_megabytes(), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
 class Query_Chooser(object):
     def __init__(self, num_queries_max, args, cost_of_asking=0, t_0=None):
         self.cost_of_asking = cost_of_asking
         self.num_queries_max = num_queries_max
         self.args = args  # all args
         self.t_0 = t_0
-        self.model_cache = {}
+        self.inference = None
+        self.model_cache = ModelCache(args.model_cache_size, args.model_cache_mb, close_sessions=args.isolate_graphs)
+        self.num_graph_builds, self.graph_build_time = 0, 0.
+        # Feature expectations of the last query posed and the index of the answer, used by ParticleInference
+        self.answered_feature_exps, self.answer = None, None
+
+        if args.isolate_graphs:
+            # Every model gets its own graph, session and resident belief when it is built
+            self.sess, self.resident_belief = None, None
+        else:
+            self.sess = self.make_session()
+            # Shared by all models so the true reward matrix and log prior are only copied into the graph once
+            self.resident_belief = ResidentBelief(args.feature_dim) if args.resident_belief else None
 
+    def make_session(self, graph=None):
         config = tf.compat.v1.ConfigProto()
         config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
+        return tf.compat.v1.Session(graph=graph, config=config)
 
     def cache_feature_expectations(self, reward_space=None):
         """Computes feature expectations for each proxy using TF and stores them in
@@ -49,19 +131,26 @@ class Query_Chooser(object):
 
         proxy_list = [list(reward) for reward in reward_space]
         print('building graph. Total experiment time: {t}'.format(t=time.clock() - self.t_0))
-        # TODO: This will build a separate model for every reward space size after eliminating duplicates
-        model = self.get_model(len(proxy_list), 'entropy', cache=(not use_proxy_space))
-        model.initialize(self.sess)
+        model = self.get_model(len(proxy_list), 'entropy')
+        model.initialize(model.sess)
 
         desired_outputs = ['feature_exps']
         mdp = self.inference.mdp
         print('Computing model outputs. Total experiment time: {t}'.format(t=time.clock() - self.t_0))
-        [feature_exp_matrix] = model.compute(
-            desired_outputs, self.sess, mdp, proxy_list)
+        if 'num_value_iters' in model.name_to_op:
+            desired_outputs.append('num_value_iters')
+        outputs = model.compute(
+            desired_outputs, model.sess, mdp, proxy_list)
+        feature_exp_matrix = outputs[0]
         print('Done computing model outputs. Total experiment time: {t}'.format(t=time.clock() - self.t_0))
+        if len(outputs) > 1:
+            print('Value iteration used {n} of at most {m} iterations'.format(n=outputs[1], m=self.args.value_iters))
 
         if use_proxy_space:
             self.inference.feature_exp_matrix = feature_exp_matrix
+            if self.args.cache_log_likelihoods:
+                self.inference.cache_log_likelihoods(
+                    self.args.log_likelihood_dtype, self.args.log_likelihood_cache_mb)
         return feature_exp_matrix
 
     # @profile
@@ -163,17 +252,18 @@ class Query_Chooser(object):
 
         time_last_query_found = time.clock()
 
-        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
+        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg', 'feature_exps', 'sample']
         # Set model inputs if they're not set
         if not (full_query and self.args.full_IRD_subsample_belief != 'no'):
             idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in best_query]
             feature_exp_input = self.inference.feature_exp_matrix[idx, :]
         true_reward_matrix, log_prior = self.get_true_reward_space(no_subsampling=True)
         model = self.get_model(query_size, measure, no_planning=True)
-        best_objective, true_log_posterior, true_entropy, post_avg = model.compute(
-            desired_outputs, self.sess, None, None, log_prior,
-            feature_expectations_input=feature_exp_input,
-            true_reward=true_reward, true_reward_matrix=true_reward_matrix)
+        best_objective, true_log_posterior, true_entropy, post_avg, self.answered_feature_exps, self.answer = \
+            model.compute(
+                desired_outputs, model.sess, None, None, log_prior,
+                feature_expectations_input=feature_exp_input,
+                true_reward=true_reward, true_reward_matrix=true_reward_matrix)
 
         print('Best objective found with a discrete query: ' + str(best_objective[0][0]))
         return None, best_objective[0][0], true_log_posterior, true_entropy[0], post_avg, time_last_query_found
@@ -212,18 +302,51 @@ class Query_Chooser(object):
         else:
             raise ValueError('Must add >0 proxies to query (may have selected growth rate >2 for greedy).')
 
-        true_reward_matrix, log_prior = self.get_true_reward_space()
+        # Score queries by gathering cached log likelihoods if possible
+        use_log_likelihood_cache = self.inference.log_likelihood_matrix is not None and \
+                                   measure != 'total_variation' and not self.args.posterior_block_size
+        if use_log_likelihood_cache:
+            true_idx, log_prior = self.get_true_reward_idx()
+        else:
+            true_reward_matrix, log_prior = self.get_true_reward_space()
+        # Score all extensions in one batched evaluation. The batched model needs the full posterior, so queries are
+        # scored one at a time when the posterior is computed in blocks.
+        if self.args.batch_query_scoring and measure != 'total_variation' and not self.args.posterior_block_size:
+            model = self.get_model(len(curr_query) + num_to_add, measure, no_planning=True, batched=True)
+            queries = [curr_query + query for query in query_extensions]
+            query_idx = np.array(
+                [[self.inference.reward_index_proxy[tuple(reward)] for reward in query] for query in queries])
+            if use_log_likelihood_cache:
+                [objectives] = model.compute_batch(
+                    [measure], model.sess, query_idx, log_prior,
+                    proxy_log_likelihoods=self.inference.get_log_likelihoods(slice(None), true_idx),
+                    max_megabytes=self.args.query_batch_mb)
+            else:
+                [objectives] = model.compute_batch(
+                    [measure], model.sess, query_idx, log_prior,
+                    proxy_feature_exps=self.inference.feature_exp_matrix, true_reward_matrix=true_reward_matrix,
+                    max_megabytes=self.args.query_batch_mb)
+            objectives = objectives.reshape(-1)
+            best = np.nanargmin(objectives)
+            print('Objective for size {s}: '.format(s=len(queries[best])) + str(objectives[best]))
+            return queries[best], objectives[best]
+
         model = self.get_model(len(curr_query) + num_to_add, measure, no_planning=True)
         for query in query_extensions:
             query = curr_query + query  # query must be LIST of one or more arrays
             idx = [self.inference.reward_index_proxy[tuple(reward)] for reward in query]
-            feature_exp_input = self.inference.feature_exp_matrix[idx, :]
 
             # Compute objective
-            objective = model.compute(
-                [measure], self.sess, None, None, log_prior,
-                feature_expectations_input=feature_exp_input,
-                true_reward_matrix=true_reward_matrix)
+            if use_log_likelihood_cache:
+                objective = model.compute(
+                    [measure], model.sess, None, None, log_prior,
+                    log_likelihoods=self.inference.get_log_likelihoods(idx, true_idx))
+            else:
+                feature_exp_input = self.inference.feature_exp_matrix[idx, :]
+                objective = model.compute(
+                    [measure], model.sess, None, None, log_prior,
+                    feature_expectations_input=feature_exp_input,
+                    true_reward_matrix=true_reward_matrix)
 
             if objective[0][0][0] < best_objective:
                 best_objective = objective
@@ -238,13 +361,14 @@ class Query_Chooser(object):
 
         time_last_query_found = time.clock
 
-        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
+        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg', 'feature_exps', 'sample']
         true_reward_matrix, log_prior = self.get_true_reward_space(no_subsampling=True)
         mdp = self.inference.mdp
         model = self.get_model(query_size, measure)
-        best_objective, true_log_posterior, true_entropy, post_avg = model.compute(
-            desired_outputs, self.sess, mdp, best_query, log_prior,
-            true_reward=true_reward, true_reward_matrix=true_reward_matrix)
+        best_objective, true_log_posterior, true_entropy, post_avg, self.answered_feature_exps, self.answer = \
+            model.compute(
+                desired_outputs, model.sess, mdp, best_query, log_prior,
+                true_reward=true_reward, true_reward_matrix=true_reward_matrix)
 
         print('Best objective found with optimized discrete query: ' + str(best_objective[0][0]))
         return best_query, best_objective[0][0], true_log_posterior, true_entropy[0], post_avg, time_last_query_found
@@ -256,9 +380,9 @@ class Query_Chooser(object):
         dim, steps = self.args.feature_dim, self.args.num_iters_optim
         model = self.get_model(
             len(curr_query) + num_to_add, measure, num_unknown=num_to_add, optimize=True)
-        model.initialize(self.sess)
+        model.initialize(model.sess)
         objective, optimal_new_rewards = model.compute(
-            desired_outputs, self.sess, mdp, curr_query, log_prior,
+            desired_outputs, model.sess, mdp, curr_query, log_prior,
             weight_inits=np.random.randn(num_to_add, dim), gradient_steps=steps,
             # gradient_logging_outputs=[measure, 'weights_to_train'],
             gradient_logging_outputs=[measure],
@@ -283,7 +407,7 @@ class Query_Chooser(object):
         lr = ent.round(0) if ent > 1 else ent.round(1)
         for i, feature in enumerate(features):
             # Resampling weights for each feature
-            model.initialize(self.sess)
+            model.initialize(model.sess)
             query = curr_query + [feature]
             weights = None
             if not self.search:
@@ -313,11 +437,11 @@ class Query_Chooser(object):
 
                 # Calculate (optimized) objective
                 # objective_before_optim = model.compute(
-                #     desired_outputs, self.sess, mdp, query, log_prior,
+                #     desired_outputs, model.sess, mdp, query, log_prior,
                 #     weights, lr=lr,
                 #     true_reward_matrix=true_reward_matrix)
                 objective, optimal_weights, feature_exps = model.compute(
-                    desired_outputs, self.sess, mdp, query, log_prior,
+                    desired_outputs, model.sess, mdp, query, log_prior,
                     weights, gradient_steps=gd_steps, lr=lr,
                     # gradient_logging_outputs=[measure, 'weights_to_train[:3]'],#, 'gradients[:4]'],#, 'state_probs_cut'],
                     true_reward_matrix=true_reward_matrix)
@@ -350,7 +474,7 @@ class Query_Chooser(object):
                 # Optimize from best sample if desired
                 if not self.no_optimize:
                     objective, optimal_weights, feature_exps = model.compute(
-                        desired_outputs, self.sess, mdp, query, log_prior,
+                        desired_outputs, model.sess, mdp, query, log_prior,
                         optimal_weights, gradient_steps=gd_steps, lr=lr,
                         # gradient_logging_outputs=[measure, 'weights_to_train[:3]'],#, 'gradients[:4]'],#, 'state_probs_cut'],
                         true_reward_matrix=true_reward_matrix)
@@ -386,18 +510,19 @@ class Query_Chooser(object):
         print('query found')
 
         # For the chosen query, get posterior from human answer. If using human input, replace with feature exps or trajectories.
-        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg']
+        desired_outputs = [measure, 'true_log_posterior', 'true_entropy', 'post_avg', 'feature_exps', 'sample']
         true_reward_matrix, log_prior = self.get_true_reward_space(no_subsampling=True)
 
         time_last_query_found = time.clock()
 
         disc_size = self.args.discretization_size_human
         model = self.get_model(query_size, measure, discrete=False, discretization_size=disc_size, optimize=True)
-        model.initialize(self.sess)
-        objective, true_log_posterior, true_entropy, post_avg = model.compute(
-            desired_outputs, self.sess, mdp, best_query, log_prior,
-            weight_inits=best_weights,
-            true_reward=true_reward, true_reward_matrix=true_reward_matrix)
+        model.initialize(model.sess)
+        objective, true_log_posterior, true_entropy, post_avg, self.answered_feature_exps, self.answer = \
+            model.compute(
+                desired_outputs, model.sess, mdp, best_query, log_prior,
+                weight_inits=best_weights,
+                true_reward=true_reward, true_reward_matrix=true_reward_matrix)
         print('Best full posterior objective found (human discretization, continuous): ' + str(objective[0][0]))
 
         return best_query, objective[0][0], true_log_posterior, true_entropy[0], post_avg, time_last_query_found
@@ -418,7 +543,7 @@ class Query_Chooser(object):
         weights = self.sample_weights('init', num_fixed)
 
         objective, weights, feature_exps = model.compute(
-            desired_outputs, self.sess, mdp, query, log_prior,
+            desired_outputs, model.sess, mdp, query, log_prior,
             weights,
             true_reward_matrix=true_reward_matrix)
 
@@ -435,7 +560,7 @@ class Query_Chooser(object):
 
             # Calculate objective
             objective_disc, optimal_weights_disc, feature_exps_disc = model.compute(
-                desired_outputs, self.sess, mdp, query, log_prior,
+                desired_outputs, model.sess, mdp, query, log_prior,
                 other_weights, true_reward_matrix=true_reward_matrix)
 
             # Update best variables
@@ -487,6 +612,10 @@ class Query_Chooser(object):
         return weights
 
     def set_inference(self, inference, cache_feature_exps):
+        # Only the current inference's log likelihoods are used, so free those of the previous one. Otherwise every
+        # training MDP would keep its own size_proxy x size_true matrix.
+        if self.inference is not None and self.inference is not inference:
+            self.inference.log_likelihood_matrix = None
         self.inference = inference
         if cache_feature_exps:
             self.cache_feature_expectations()
@@ -502,45 +631,53 @@ class Query_Chooser(object):
         return [list(x) for x in combinations(self.inference.reward_space_proxy, query_size)]
 
     def get_true_reward_space(self, no_subsampling=False):
+        true_idx, log_prior = self.get_true_reward_idx(no_subsampling)
+        if true_idx is None:
+            true_reward_matrix = self.inference.true_reward_matrix
+        else:
+            true_reward_matrix = self.inference.true_reward_matrix[true_idx]
+        return true_reward_matrix, log_prior
+
+    def get_true_reward_idx(self, no_subsampling=False):
+        """Same as get_true_reward_space, but returns indices into inference.true_reward_matrix instead of the true
+        rewards. The indices are None if the whole true reward space is used."""
         if self.args.subsampling and not no_subsampling:
-            # num_subsamples = self.args.num_subsamples
             # Get true reward samples to optimize with
-            true_reward_matrix, log_prior = self.sample_true_reward_matrix()
-            # log_prior = np.log(np.ones(num_subsamples) / num_subsamples)
+            true_idx, log_prior = self.sample_true_reward_idx()
         else:
-            true_reward_matrix = self.inference.true_reward_matrix
+            true_idx = None
             log_prior = self.inference.log_prior
-        return true_reward_matrix, log_prior
+        return true_idx, log_prior
 
     def sample_true_reward_matrix(self, uniform_sampling=False):
+        true_idx, log_prior = self.sample_true_reward_idx(uniform_sampling)
+        return self.inference.true_reward_matrix[true_idx], log_prior
+
+    def sample_true_reward_idx(self, uniform_sampling=False):
         num_subsamples = self.args.num_subsamples
         if uniform_sampling:
             probs = np.ones(len(self.inference.log_prior))
+            probs = probs / probs.sum()
+            choices = np.random.choice(len(probs), p=probs, size=num_subsamples)
             weighting = False
         else:
-            log_probs = self.inference.log_prior
-            probs = np.exp(log_probs)
+            choices = self.inference.sample_true_reward_idx(num_subsamples)
             weighting = self.args.weighting
-        probs = probs / probs.sum()
-        choices = np.random.choice(self.args.size_true_space, p=probs, size=num_subsamples)
         if weighting:
             unique_sample_idx, counts = np.unique(choices, return_counts=True)
 
             weighted_probs = np.ones(len(counts)) * counts
             weighted_probs = weighted_probs / weighted_probs.sum()
-            return self.inference.true_reward_matrix[unique_sample_idx], np.log(weighted_probs)
+            return unique_sample_idx, np.log(weighted_probs)
         else:
             unif_log_prior = np.log(np.ones(num_subsamples) / num_subsamples)
-            return self.inference.true_reward_matrix[choices], unif_log_prior
+            return choices, unif_log_prior
 
     def get_model(self, query_size, objective, num_unknown=None,
                   discrete=True, optimize=False, no_planning=False, cache=True, rational_planner=False,
-                  discretization_size=None):
+                  discretization_size=None, batched=False):
         mdp = self.inference.mdp
-        height, width = None, None
         # TODO: Replace mdp.type with self.args.mdp_type
-        if mdp.type == 'gridworld':
-            height, width = mdp.height, mdp.width
         dim, gamma, lr = self.args.feature_dim, self.args.gamma, self.args.lr
         beta, beta_planner = self.args.beta, self.args.beta_planner
         if rational_planner:
@@ -550,36 +687,103 @@ class Query_Chooser(object):
             discretization_size = self.args.discretization_size
         true_reward_space_size = None
         # true_reward_space_size = len(self.inference.true_reward_matrix)
-        key = (no_planning, mdp.type, dim, gamma, query_size,
-               discretization_size, true_reward_space_size, num_unknown, beta,
-               beta_planner, lr, discrete, optimize, height, width, num_iters, objective)
-        if key in self.model_cache:
-            return self.model_cache[key]
+        # Discrete models work for any query size and grid size. Continuous models have a weight for every
+        # feature that isn't queried and a fixed discretization of the queried ones.
+        if discrete:
+            query_size_key, discretization_size_key = None, None
+        else:
+            query_size_key, discretization_size_key = query_size, discretization_size
+        num_iters_key = num_iters if mdp.type == 'gridworld' and not no_planning else None
+        key = (no_planning, batched, mdp.type, dim, gamma, query_size_key,
+               discretization_size_key, true_reward_space_size, num_unknown, beta,
+               beta_planner, lr, discrete, optimize, num_iters_key, objective)
+        model = self.model_cache.get(key)
+        if model is not None:
+            return model
 
         print('building model...')
-        if no_planning:
+        build_start = time.clock()
+        if self.args.isolate_graphs:
+            graph = tf.Graph()
+            # Use the global seed. Op seeds also depend on the position of the op in its graph, so random draws (such
+            # as sampled answers) differ from those of models in the default graph, and a model that is rebuilt after
+            # being evicted repeats the draws of the evicted one.
+            graph.seed = tf.compat.v1.get_default_graph().seed
+            with graph.as_default():
+                resident_belief = ResidentBelief(dim) if self.args.resident_belief else None
+                model = self.build_model(
+                    no_planning, batched, mdp, dim, gamma, query_size, discretization_size, true_reward_space_size,
+                    num_unknown, beta, beta_planner, objective, lr, discrete, optimize, num_iters, resident_belief)
+            model.sess = self.make_session(graph)
+            megabytes = graph.as_graph_def().ByteSize() / 1e6
+            if resident_belief is not None:
+                # The resident belief keeps a float32 copy of the true reward matrix and log prior
+                megabytes += len(self.inference.true_reward_matrix) * (dim + 1) * 4 / 1e6
+        else:
+            model = self.build_model(
+                no_planning, batched, mdp, dim, gamma, query_size, discretization_size, true_reward_space_size,
+                num_unknown, beta, beta_planner, objective, lr, discrete, optimize, num_iters, self.resident_belief)
+            model.sess = self.sess
+            megabytes = 0
+
+        self.num_graph_builds += 1
+        self.graph_build_time += time.clock() - build_start
+        print('Models built so far: {n} in {t:.1f}s'.format(n=self.num_graph_builds, t=self.graph_build_time))
+        if cache:
+            self.model_cache.add(key, model, megabytes)
+            print('Model built and cached! Model cache: ' + str(self.model_cache))
+        return model
+
+    def build_model(self, no_planning, batched, mdp, dim, gamma, query_size, discretization_size,
+                    true_reward_space_size, num_unknown, beta, beta_planner, objective, lr, discrete, optimize,
+                    num_iters, resident_belief):
+        if no_planning and batched:
+            model = BatchedNoPlanningModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, self.args, resident_belief)
+        elif no_planning:
             model = NoPlanningModel(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
-                objective, lr, discrete, optimize, self.args)
+                objective, lr, discrete, optimize, self.args, resident_belief)
+        elif mdp.type == 'gridworld' and batched:
+            model = BatchedGridworldModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, mdp.height, mdp.width,
+                num_iters, self.args, resident_belief)
+        elif mdp.type == 'gridworld' and self.args.tabular_planner:
+            model = TabularModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, None, None,
+                num_iters, self.args, resident_belief)
+        elif mdp.type == 'bandits' and self.args.feature_block_size > 0:
+            model = StreamingBanditsModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, self.args, resident_belief)
         elif mdp.type == 'bandits':
             print('Calling BanditsModel')
             model = BanditsModel(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
-                objective, lr, discrete, optimize, self.args)
+                objective, lr, discrete, optimize, self.args, resident_belief)
+        elif mdp.type == 'gridworld' and self.args.sparse_planner:
+            model = SparseGridworldModel(
+                dim, gamma, query_size, discretization_size,
+                true_reward_space_size, num_unknown, beta, beta_planner,
+                objective, lr, discrete, optimize, mdp.height, mdp.width,
+                num_iters, self.args, resident_belief)
         elif mdp.type == 'gridworld':
             model = GridworldModel(
                 dim, gamma, query_size, discretization_size,
                 true_reward_space_size, num_unknown, beta, beta_planner,
                 objective, lr, discrete, optimize, mdp.height, mdp.width,
-                num_iters, self.args)
+                num_iters, self.args, resident_belief)
         else:
             raise ValueError('Unknown model type: ' + str(mdp.type))
-
-        if cache:
-            self.model_cache[key] = model
-            print('Model built and cached!')
         return model
 
 
@@ -605,6 +809,11 @@ class Experiment(object):
         self.test_inferences = test_inferences
         self.true_rewards = true_rewards
         self.prior_avg = prior_avg
+        # Maps (mdp, tuple(true_reward)) to the feature expectations and return of planning with the true reward.
+        # Shared by all choosers since neither changes during an experiment.
+        self.optimal_plans = {}
+        # Maps each mdp to the feature expectations of all its states under the last post_avg, see plan_in_test_mdps
+        self.warm_starts = {} if args.warm_start else None
 
     # @profile
     def get_experiment_stats(self, num_iter, num_experiments):
@@ -616,6 +825,9 @@ class Experiment(object):
             self.write_experiment_results_to_csv(exp_num, num_iter)
 
         self.write_mean_and_median_results_to_csv(num_experiments, num_iter)
+        print('Built {n} TF graphs in {t:.1f}s. Model cache: {cache}'.format(
+            n=self.query_chooser.num_graph_builds, t=self.query_chooser.graph_build_time,
+            cache=self.query_chooser.model_cache))
 
         return self.results
 
@@ -652,7 +864,10 @@ class Experiment(object):
                     query, perf_measure, true_log_posterior, true_entropy, post_avg, time_last_query_found \
                         = self.query_chooser.find_query(self.query_size, chooser, true_reward)
                     # query = [np.array(proxy) for proxy in query]    # unnecessary?
-                    inference.update_prior(None, None, true_log_posterior)
+                    inference.update_prior(
+                        self.query_chooser.answered_feature_exps, self.query_chooser.answer, true_log_posterior)
+                    if self.query_chooser.args.support_tolerance > 0:
+                        inference.prune_support(self.query_chooser.args.support_tolerance)
                 # Log outcomes before 1st query
                 else:
                     query = None
@@ -690,21 +905,12 @@ class Experiment(object):
                       std_proxy, mean_proxy, std_goal, mean_goal
 
     def get_posterior_variance(self, inference):
-        """Gets posterior mean and std for last and 2nd last feature by sampling."""
-        args = self.query_chooser.args
-        feature_dim = args.feature_dim
-        # query_matrix_sample, log_prior_sample = self.query_chooser.sample_true_reward_matrix()
-        log_probs = inference.log_prior
-        probs = np.exp(log_probs)
-        probs = probs / probs.sum()
-        choices = np.random.choice(args.size_true_space, p=probs, size=50000)
-        # unif_log_prior = np.log(np.ones(10000) / 10000)
-
-        posterior_samples = inference.true_reward_matrix[choices]
-        std = np.std(posterior_samples, 0)
-        means = np.mean(posterior_samples, 0)
-
-        unique_sample_idx, counts = np.unique(choices, return_counts=True)
+        """Gets exact posterior mean and std for last and 2nd last feature. The mean is computed from the current
+        belief rather than taken from the model's post_avg, which is stale once the support is pruned or particles
+        are rejuvenated."""
+        feature_dim = self.query_chooser.args.feature_dim
+        means, variances, _ = inference.get_posterior_summary()
+        std = np.sqrt(variances)
 
         proxy_idx = feature_dim - 2
         goal_idx = feature_dim - 1
@@ -721,28 +927,17 @@ class Experiment(object):
         else:
             inferences = [inference]
 
-        regrets = np.empty(len(self.test_inferences))
-        for i, inference in enumerate(inferences):
-            # New method using TF:
-            test_mdp = inference.mdp
-            planning_model = self.query_chooser.get_model(1, 'entropy',
-                                                          rational_planner=self.query_chooser.args.rational_test_planner)
-
-            [post_avg_feature_exps] = planning_model.compute(['feature_exps'], self.query_chooser.sess, test_mdp,
-                                                             [list(post_avg)])
-            [true_reward_feature_exps] = planning_model.compute(['feature_exps'], self.query_chooser.sess, test_mdp,
-                                                                [list(true_reward)])
-
-            optimal_reward = np.dot(true_reward_feature_exps, true_reward)
-            test_reward = np.dot(post_avg_feature_exps, true_reward)
-            regret = optimal_reward - test_reward
-            regrets[i] = regret
-
-            # Old method (using normalized feature exps in Python)
-            # test_reward = inference.get_avg_reward(post_avg, true_reward)
-            # optimal_reward = inference.get_avg_reward(true_reward, true_reward)
-            # regret = optimal_reward - test_reward
-            # regrets[i] = regret
+        test_mdps = [inference.mdp for inference in inferences]
+        optimal_rewards = self.get_optimal_plans(test_mdps, true_reward)[1]
+        post_avg_feature_exps = self.plan_in_test_mdps(test_mdps, [post_avg], self.warm_starts)[:, 0]
+        test_rewards = np.dot(post_avg_feature_exps, true_reward)
+        regrets = optimal_rewards - test_rewards
+
+        # Old method (using normalized feature exps in Python)
+        # test_reward = inference.get_avg_reward(post_avg, true_reward)
+        # optimal_reward = inference.get_avg_reward(true_reward, true_reward)
+        # regret = optimal_reward - test_reward
+        for regret in regrets:
             if regret < -1:
                 if len(inferences) == 1:
                     text = ' (post_regret)'
@@ -752,6 +947,84 @@ class Experiment(object):
                 print('regret: ' + str(regret) + text)
         return regrets.mean()
 
+    def get_optimal_plans(self, mdps, true_reward):
+        """Returns the num_mdps x dim feature expectations and the num_mdps returns of planning with the true reward
+        in every MDP. Only MDPs that haven't been planned in for this true reward before are planned in."""
+        true_reward_key = tuple(true_reward)
+        new_mdps = [mdp for mdp in mdps if (mdp, true_reward_key) not in self.optimal_plans]
+        if new_mdps:
+            feature_exps = self.plan_in_test_mdps(new_mdps, [true_reward])[:, 0]
+            for mdp, mdp_feature_exps in zip(new_mdps, feature_exps):
+                self.optimal_plans[mdp, true_reward_key] = mdp_feature_exps, np.dot(mdp_feature_exps, true_reward)
+        feature_exps, optimal_rewards = zip(*[self.optimal_plans[mdp, true_reward_key] for mdp in mdps])
+        return np.array(feature_exps), np.array(optimal_rewards)
+
+    def plan_in_test_mdps(self, mdps, rewards, warm_starts=None):
+        """Returns the num_mdps x num_rewards x dim feature expectations of planning with every reward in every MDP.
+
+        With --regret_batch_size, gridworlds are planned in regret_batch_size at a time with a single evaluation of a
+        BatchedGridworldModel, which is a dense planner without noise. Otherwise every MDP and reward is planned in
+        separately.
+
+        warm_starts maps MDPs to the feature expectations of all states from planning in them before (one row per
+        reward). If given, value iteration starts from these and they are replaced by the new solutions. Solutions are
+        only kept if value iteration converged to within --value_iter_tolerance, since a finite-horizon solution would
+        add another horizon when planning from it. This is ignored by planners that don't use value iteration."""
+        args = self.query_chooser.args
+        batch_size = args.regret_batch_size
+        rewards = [list(reward) for reward in rewards]
+        feature_exps = np.empty([len(mdps), len(rewards), args.feature_dim])
+        if batch_size > 0 and mdps[0].type == 'gridworld':
+            planning_model = self.query_chooser.get_model(1, 'entropy', rational_planner=args.rational_test_planner,
+                                                          batched=True)
+            for start in range(0, len(mdps), batch_size):
+                batch = mdps[start:start + batch_size]
+                # One row for every pair of MDP and reward
+                batch_mdps = [mdp for mdp in batch for _ in rewards]
+                batch_rewards = [reward for _ in batch for reward in rewards]
+                if warm_starts is None:
+                    [batch_feature_exps] = planning_model.compute(['feature_exps'], planning_model.sess, batch_mdps,
+                                                                  batch_rewards)
+                else:
+                    initial_feature_exps = None
+                    if all(mdp in warm_starts for mdp in batch):
+                        initial_feature_exps = np.concatenate([warm_starts[mdp] for mdp in batch])
+                    batch_feature_exps, all_feature_exps, value_iter_change = planning_model.compute(
+                        ['feature_exps', 'all_feature_exps', 'value_iter_change'], planning_model.sess, batch_mdps,
+                        batch_rewards, initial_feature_exps=initial_feature_exps)
+                    for i, mdp in enumerate(batch):
+                        mdp_feature_exps = all_feature_exps[i * len(rewards):(i + 1) * len(rewards)]
+                        self.update_warm_start(warm_starts, mdp, mdp_feature_exps, value_iter_change)
+                feature_exps[start:start + len(batch)] = batch_feature_exps.reshape([len(batch), len(rewards), -1])
+            return feature_exps
+
+        planning_model = self.query_chooser.get_model(1, 'entropy', rational_planner=args.rational_test_planner)
+        if 'all_feature_exps' not in planning_model.name_to_op:
+            warm_starts = None
+        for i, mdp in enumerate(mdps):
+            if warm_starts is None:
+                for j, reward in enumerate(rewards):
+                    [feature_exps[i, j]] = planning_model.compute(['feature_exps'], planning_model.sess, mdp, [reward])
+                continue
+            all_feature_exps, value_iter_changes = [], []
+            for j, reward in enumerate(rewards):
+                initial_feature_exps = warm_starts[mdp][j:j + 1] if mdp in warm_starts else None
+                [feature_exps[i, j]], reward_all_feature_exps, value_iter_change = planning_model.compute(
+                    ['feature_exps', 'all_feature_exps', 'value_iter_change'], planning_model.sess, mdp, [reward],
+                    initial_feature_exps=initial_feature_exps)
+                all_feature_exps.append(reward_all_feature_exps)
+                value_iter_changes.append(value_iter_change)
+            self.update_warm_start(warm_starts, mdp, np.concatenate(all_feature_exps), max(value_iter_changes))
+        return feature_exps
+
+    def update_warm_start(self, warm_starts, mdp, all_feature_exps, value_iter_change):
+        """Keeps all_feature_exps to warm start planning in mdp next time if value iteration converged, and otherwise
+        plans from scratch next time."""
+        if value_iter_change <= self.query_chooser.args.value_iter_tolerance:
+            warm_starts[mdp] = all_feature_exps
+        else:
+            warm_starts.pop(mdp, None)
+
     def get_normalized_reward_diff(self, post_avg, true_reward):
         norm_post_avg = (post_avg - post_avg.mean())
         norm_post_avg = norm_post_avg / np.linalg.norm(norm_post_avg, ord=2)
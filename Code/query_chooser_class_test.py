@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from query_chooser_class import Experiment
+
+
+class PlanRecordingExperiment(Experiment):
+    """Plans with fixed feature expectations for every MDP and records which MDPs were planned in."""
+
+    def __init__(self, mdp_feature_exps):
+        self.mdp_feature_exps = mdp_feature_exps
+        self.optimal_plans = {}
+        self.planned_mdps = []
+
+    def plan_in_test_mdps(self, mdps, rewards, warm_starts=None):
+        self.planned_mdps.append(list(mdps))
+        return np.array([[self.mdp_feature_exps[mdp] + reward for reward in rewards] for mdp in mdps])
+
+
+class TestOptimalPlans(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.mdp_feature_exps = {mdp: np.random.rand(4) for mdp in ['a', 'b', 'c']}
+        self.experiment = PlanRecordingExperiment(self.mdp_feature_exps)
+        self.true_reward = np.random.randint(-9, 10, size=4)
+
+    def check_optimal_plans(self, mdps, true_reward):
+        feature_exps, optimal_rewards = self.experiment.get_optimal_plans(mdps, true_reward)
+        expected = np.array([self.mdp_feature_exps[mdp] + true_reward for mdp in mdps])
+        np.testing.assert_array_equal(feature_exps, expected)
+        np.testing.assert_allclose(optimal_rewards, np.dot(expected, true_reward))
+
+    def test_only_new_mdps_are_planned_in(self):
+        self.check_optimal_plans(['a', 'b'], self.true_reward)
+        self.check_optimal_plans(['b', 'c', 'a'], self.true_reward)
+        self.check_optimal_plans(['c'], self.true_reward)
+        self.assertEqual(self.experiment.planned_mdps, [['a', 'b'], ['c']])
+
+    def test_plans_depend_on_true_reward(self):
+        self.check_optimal_plans(['a'], self.true_reward)
+        self.check_optimal_plans(['a'], -self.true_reward)
+        self.assertEqual(self.experiment.planned_mdps, [['a'], ['a']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,10 +12,12 @@ from query_chooser_class import Experiment
 from gridworld import (
     GridworldEnvironment,
     NStateMdpGaussianFeatures,
-    GridworldMdpWithDistanceFeatures,
-    GridworldMdp
+    NStateMdpStreamedGaussianFeatures,
+    GridworldMdpWithDistanceFeatures
 )
-from inference_class import Inference
+from inference_class import Inference, ParticleInference
+from env_cache import get_env_cache_path, load_envs, save_envs, restore_random_states, gridworlds_to_arrays, \
+    arrays_to_gridworlds, get_shared_array
 
 print('Time to import: {deltat}'.format(deltat=time.clock() - start))
 
@@ -38,8 +40,16 @@ if __name__ == '__main__':
     parser.add_argument('--num_subsamples', type=int, default=10000)
     parser.add_argument('--weighting', type=int, default=1)
     parser.add_argument('--value_iters', type=int, default=15)  # Max_reward / (1-gamma) or height+width
-
+    parser.add_argument('--value_iter_tolerance', type=float, default=0)  # >0: stop value iteration at this max change
+    parser.add_argument('--sparse_planner', type=int, default=0)  # Plan only over the states that aren't walls
+    parser.add_argument('--tabular_planner', type=int, default=0)  # Plan gridworlds on their compiled transitions
+    parser.add_argument('--noise', type=float, default=0)  # Gridworld slip probability. Needs --tabular_planner
+    parser.add_argument('--regret_batch_size', type=int, default=0)  # >0: plan in this many test gridworlds at once
+    parser.add_argument('--warm_start', type=int, default=0)  # Replan regret from last converged solution
+
+    parser.add_argument('--num_workers', type=int, default=0)  # Processes to build gridworlds in, same results for any
     parser.add_argument('--num_states', type=int, default=100)  # 10 options if env changes over time, 100 otherwise
+    parser.add_argument('--feature_block_size', type=int, default=0)  # >0: stream bandit features in blocks this big
     parser.add_argument('--linear_features', type=int, default=1)
     parser.add_argument('--feature_dim', type=int, default=20)  # 10 if positions fixed, 100 otherwise
     parser.add_argument('--size_true_space', type=int,
@@ -79,8 +89,44 @@ if __name__ == '__main__':
     parser.add_argument('--proxy_space_is_true_space', type=int, default=0)
     parser.add_argument('--full_IRD_subsample_belief', type=str, default='no')  # other options: yes, uniform
 
+    # args for performance
+    parser.add_argument('--cache_log_likelihoods', type=int, default=1)  # Cache size_proxy x size_true log likelihoods
+    parser.add_argument('--log_likelihood_dtype', type=str, default='float32')  # e.g. float16 to halve the memory
+    parser.add_argument('--log_likelihood_cache_mb', type=float, default=2000)  # Don't cache if it takes more memory
+    parser.add_argument('--batch_query_scoring', type=int, default=1)  # Score all candidate discrete queries at once
+    parser.add_argument('--query_batch_mb', type=float, default=500)  # Memory budget per chunk of batched queries
+    parser.add_argument('--resident_belief', type=int, default=1)  # Keep true reward matrix and log prior in the graph
+    parser.add_argument('--posterior_block_size', type=int, default=0)  # >0: compute posterior in blocks of true rewards
+    parser.add_argument('--support_tolerance', type=float, default=0)  # >0: drop true rewards with this much total mass
+    parser.add_argument('--isolate_graphs', type=int, default=0)  # Own graph and session per model. Alters random draws
+    parser.add_argument('--model_cache_size', type=int, default=0)  # Max number of cached models, 0 for no limit
+    parser.add_argument('--model_cache_mb', type=float, default=0)  # Max MB of cached models, 0 for no limit
+    parser.add_argument('--belief', type=str, default='enumerated')  # other option: particles
+    parser.add_argument('--num_particles', type=int, default=10000)  # Belief size if belief is particles
+    parser.add_argument('--ess_threshold', type=float, default=0.5)  # Resample below this fraction of num_particles
+    parser.add_argument('--rejuvenation_steps', type=int, default=5)  # MH sweeps after resampling particles
+    parser.add_argument('--env_cache_dir', type=str, default='')  # Save generated envs here and load them next time
+    parser.add_argument('--shared_reward_space_dir', type=str, default='')  # Map true rewards from a shared file, fed
+
     args = parser.parse_args()
     print(args)
+    if args.belief == 'particles' and args.support_tolerance > 0:
+        raise ValueError('Support pruning is not supported for particle beliefs')
+    if args.noise > 0 and not args.tabular_planner:
+        raise ValueError('Only the tabular planner models noisy transitions')
+    if args.tabular_planner and args.mdp_type != 'gridworld':
+        raise ValueError('The tabular planner plans value_iters steps ahead, which only makes sense for gridworlds')
+    if args.regret_batch_size > 0 and (args.tabular_planner or args.sparse_planner):
+        raise ValueError('Only the dense gridworld planner plans in batches, set --regret_batch_size to 0')
+    if args.warm_start and not (args.gamma < 1 and args.value_iter_tolerance > 0):
+        # Otherwise value iteration has no fixed point to converge to, and warm starts add to the planning horizon
+        raise ValueError('Warm starts need --gamma < 1 and --value_iter_tolerance > 0')
+    if (args.model_cache_size or args.model_cache_mb) and not args.isolate_graphs:
+        raise ValueError('Evicting models only frees memory if every model has its own graph, set --isolate_graphs')
+    if args.shared_reward_space_dir and args.resident_belief:
+        # A resident belief copies the shared true reward space into every graph
+        print('Feeding the belief to the models, since --shared_reward_space_dir is set')
+        args.resident_belief = 0
     # assert args.discretization_size % 2 == 1
 
     # Set parameters
@@ -140,130 +186,147 @@ if __name__ == '__main__':
         # 'num_obj_if_corr': args.num_obj_if_repeated
     }
 
-    # Sample True Reward Space
-    reward_space_true = np.array(
-        np.random.randint(-9, 10, size=[size_reward_space_true, args.feature_dim]),
-        # Default - 1,000,000 arrays each containing 10 elements
-        dtype=np.int16
-    )
-
-    # Sample True Rewards
-    if not args.well_spec:
-        true_rewards = np.array(
-            np.random.randint(-9, 10, size=[args.feature_dim]) for _ in range(num_experiments)
-        )
-    else:
-        true_rewards = [choice(reward_space_true) for _ in range(num_experiments)]
-
-        if args.repeated_obj:  # for correlated features
-            # Set values of proxy and goal
-            for i, reward in enumerate(true_rewards):
-                for j in range(args.feature_dim):
-                    if reward[j] > 7: reward[j] = np.random.randint(-9, 6)
-                reward[-1] = 9
-                reward[-2] = -2
-                true_rewards[i] = reward
-                reward_space_true[i, :] = reward
-
-    # iniital prior reward associated with each feature
-    prior_avg = -0.5 * np.ones(args.feature_dim) + 1e-4 * np.random.exponential(1,
-                                                                                args.feature_dim)  # post_avg for uniform prior + noise
-
-    # Set up env and agent for NStateMdp
-    if args.mdp_type == 'bandits':
-
-        # Create train and test MDPs
-        test_mdps = []
-        for i in range(args.num_test_envs):
-            mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0,
-                                            preterminal_states=[],
-                                            feature_dim=args.feature_dim, num_states_reachable=num_states,
-                                            SEED=SEED + i * 50 + 100)
-            test_mdps.append(mdp)
-
-        train_mdps = []
-        for i in range(num_experiments):
-            mdp = NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0,
-                                            preterminal_states=[],
-                                            feature_dim=args.feature_dim, num_states_reachable=num_states,
-                                            SEED=SEED + i * 50)
-            train_mdps.append(mdp)
-
-        # Create train and test inferences
-        test_inferences = []
-        for i in range(args.num_test_envs):
-            mdp = test_mdps[i]
-            env = GridworldEnvironment(mdp)
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy=[])
-
-            test_inferences.append(inference)
-
-        train_inferences = []
-        for i in range(num_experiments):
-            mdp = train_mdps[i]
-            env = GridworldEnvironment(mdp)
-            reward_space_proxy = reward_space_true if args.proxy_space_is_true_space \
-                else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim])
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy)
-
-            train_inferences.append(inference)
-
-
-    # Set up env and agent for gridworld
-    elif args.mdp_type == 'gridworld':
-        # Create train and test MDPs
-        test_inferences = []
-
-        for i in range(args.num_test_envs):
-            test_grid, test_goals = GridworldMdp.generate_random(
-                args,
-                height,
-                width,
-                0.35,
-                args.feature_dim,
-                None,
-                living_reward=-0.01,
-                print_grid=False,
-                decorrelate=args.decorrelate_test_feat
-            )
-            mdp = GridworldMdpWithDistanceFeatures(
-                test_grid,
-                test_goals,
-                args,
-                dist_scale,
-                living_reward=-0.01,
-                noise=0
-            )
-            env = GridworldEnvironment(mdp)
-
-            inference = Inference(
-                mdp,
-                env,
-                beta,
-                reward_space_true,
-                reward_space_proxy=[]
-            )
-
-            test_inferences.append(inference)
-
-        train_inferences = []
-        for j in range(num_experiments):
-            grid, goals = GridworldMdp.generate_random(args, height, width, 0.35, args.feature_dim, None,
-                                                       living_reward=-0.01, print_grid=False)
-            mdp = GridworldMdpWithDistanceFeatures(grid, goals, args, dist_scale, living_reward=-0.01, noise=0)
-            env = GridworldEnvironment(mdp)
-            reward_space_proxy = reward_space_true if args.proxy_space_is_true_space \
-                else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim])
-            inference = Inference(
-                mdp, env, beta, reward_space_true, reward_space_proxy)
-
-            train_inferences.append(inference)
-
+    def make_bandits_mdp(mdp_seed):
+        if args.feature_block_size > 0:
+            return NStateMdpStreamedGaussianFeatures(
+                num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0, preterminal_states=[],
+                feature_dim=args.feature_dim, num_states_reachable=num_states, SEED=mdp_seed,
+                block_size=args.feature_block_size)
+        return NStateMdpGaussianFeatures(num_states=num_states, rewards=np.zeros(args.feature_dim), start_state=0,
+                                         preterminal_states=[],
+                                         feature_dim=args.feature_dim, num_states_reachable=num_states,
+                                         SEED=mdp_seed)
+
+    def sample_reward_space_proxy():
+        return reward_space_true if args.proxy_space_is_true_space \
+            else np.random.randint(-9, 10, size=[size_reward_space_proxy, args.feature_dim])
+
+    env_cache_path = get_env_cache_path(args.env_cache_dir, args) if args.env_cache_dir else None
+    cached_envs = load_envs(env_cache_path) if env_cache_path else None
+    if cached_envs is not None:
+        # Memory-map the reward spaces and environments that an earlier run with the same arguments saved
+        print('Loading environments from ' + env_cache_path)
+        reward_space_true = cached_envs['reward_space_true']
+        true_rewards = list(cached_envs['true_rewards'])
+        prior_avg = np.array(cached_envs['prior_avg'])
+        reward_space_proxies = [reward_space_true] * num_experiments if args.proxy_space_is_true_space \
+            else list(cached_envs['reward_space_proxies'])
+        if args.mdp_type == 'bandits':
+            # Bandit features are cheap to regenerate from their seeds
+            test_mdps = [make_bandits_mdp(SEED + i * 50 + 100) for i in range(args.num_test_envs)]
+            train_mdps = [make_bandits_mdp(SEED + i * 50) for i in range(num_experiments)]
+        else:
+            test_mdps = arrays_to_gridworlds(cached_envs, 'test', args, dist_scale, args.noise)
+            train_mdps = arrays_to_gridworlds(cached_envs, 'train', args, dist_scale, args.noise)
+        # Continue drawing random numbers where the run that saved the cache did
+        restore_random_states(cached_envs)
 
     else:
-        raise ValueError('Unknown MDP type: ' + str(args.mdp_type))
+        # Sample True Reward Space
+        reward_space_true = np.array(
+            np.random.randint(-9, 10, size=[size_reward_space_true, args.feature_dim]),
+            # Default - 1,000,000 arrays each containing 10 elements
+            dtype=np.int16
+        )
+
+        # Sample True Rewards
+        if not args.well_spec:
+            true_rewards = np.array(
+                np.random.randint(-9, 10, size=[args.feature_dim]) for _ in range(num_experiments)
+            )
+        else:
+            true_rewards = [choice(reward_space_true) for _ in range(num_experiments)]
+
+            if args.repeated_obj:  # for correlated features
+                # Set values of proxy and goal
+                for i, reward in enumerate(true_rewards):
+                    for j in range(args.feature_dim):
+                        if reward[j] > 7: reward[j] = np.random.randint(-9, 6)
+                    reward[-1] = 9
+                    reward[-2] = -2
+                    true_rewards[i] = reward
+                    reward_space_true[i, :] = reward
+
+        # iniital prior reward associated with each feature
+        prior_avg = -0.5 * np.ones(args.feature_dim) + 1e-4 * np.random.exponential(1,
+                                                                                    args.feature_dim)  # post_avg for uniform prior + noise
+
+        # Set up NStateMdps
+        if args.mdp_type == 'bandits':
+            # Create train and test MDPs
+            test_mdps = []
+            for i in range(args.num_test_envs):
+                mdp = make_bandits_mdp(SEED + i * 50 + 100)
+                test_mdps.append(mdp)
+
+            train_mdps = []
+            for i in range(num_experiments):
+                mdp = make_bandits_mdp(SEED + i * 50)
+                train_mdps.append(mdp)
+
+            reward_space_proxies = [sample_reward_space_proxy() for _ in range(num_experiments)]
+
+        # Set up gridworlds
+        elif args.mdp_type == 'gridworld':
+            # Create train and test MDPs
+            # Each MDP has its own seed, so they don't depend on the number of workers
+            test_mdps = GridworldMdpWithDistanceFeatures.generate_random_mdps(
+                args, args.num_test_envs, height, width, 0.35, [SEED, 0], dist_scale, args.noise,
+                args.decorrelate_test_feat, args.num_workers)
+            train_mdps = GridworldMdpWithDistanceFeatures.generate_random_mdps(
+                args, num_experiments, height, width, 0.35, [SEED, 1], dist_scale, args.noise,
+                num_workers=args.num_workers)
+            reward_space_proxies = [sample_reward_space_proxy() for _ in range(num_experiments)]
+
+        else:
+            raise ValueError('Unknown MDP type: ' + str(args.mdp_type))
+
+        if env_cache_path is not None:
+            env_arrays = {
+                'reward_space_true': reward_space_true,
+                'true_rewards': np.array(true_rewards),
+                'prior_avg': prior_avg
+            }
+            if not args.proxy_space_is_true_space:
+                env_arrays['reward_space_proxies'] = np.array(reward_space_proxies)
+            if args.mdp_type == 'gridworld':
+                env_arrays.update(gridworlds_to_arrays(test_mdps, 'test'))
+                env_arrays.update(gridworlds_to_arrays(train_mdps, 'train'))
+            save_envs(env_cache_path, env_arrays)
+            print('Saved environments to ' + env_cache_path)
+
+    if args.shared_reward_space_dir:
+        # Replace the private true reward space by a read-only map of a file that concurrent runs share. It's stored
+        # as float32, which the models take as input, so feeding it doesn't convert it.
+        reward_space_true = get_shared_array(args.shared_reward_space_dir, reward_space_true, np.float32)
+        # Copy the true rewards, so that they don't keep the private true reward space alive
+        true_rewards = [np.array(reward, dtype=reward_space_true.dtype) for reward in true_rewards]
+        if args.proxy_space_is_true_space:
+            reward_space_proxies = [reward_space_true] * num_experiments
+
+    def make_train_inference(mdp, env, reward_space_proxy):
+        if args.belief == 'particles':
+            return ParticleInference(mdp, env, beta, reward_space_true, reward_space_proxy, args.num_particles,
+                                     args.ess_threshold, args.rejuvenation_steps)
+        elif args.belief == 'enumerated':
+            return Inference(mdp, env, beta, reward_space_true, reward_space_proxy)
+        raise ValueError('Unknown belief type: ' + str(args.belief))
+
+    # Create train and test inferences
+    test_inferences = []
+    for mdp in test_mdps:
+        env = GridworldEnvironment(mdp)
+        inference = Inference(
+            mdp, env, beta, reward_space_true, reward_space_proxy=[])
+
+        test_inferences.append(inference)
+
+    train_inferences = []
+    for mdp, reward_space_proxy in zip(train_mdps, reward_space_proxies):
+        env = GridworldEnvironment(mdp)
+        inference = make_train_inference(mdp, env, reward_space_proxy)
+
+        train_inferences.append(inference)
 
 
     # Run experiment
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class TabularMdp(object):
+    """Compiles any Mdp into integer-indexed arrays that planners can use without calling the Mdp API.
+
+    States are numbered in the order of mdp.get_states(), followed by any states that are only reached through
+    transitions (such as the terminal state of an NStateMdp). The actions of a state are numbered in the order of
+    mdp.get_actions(state), so action a can mean different things in different states.
+
+    Attributes:
+    states: List of the states, so that states[i] is the state with index i.
+    state_index: Dictionary mapping each state to its index.
+    features: num_states x feature_dim array. Terminal states have no features.
+    action_mask: num_states x num_actions float32 array of indicators for whether action a is available in state s.
+    transitions: CSR matrix of shape (num_states * num_actions) x num_states where row s * num_actions + a holds the
+        probabilities of the next states after taking action a in state s. Unavailable actions have empty rows.
+    start_index: Index of the start state.
+    """
+
+    def __init__(self, mdp):
+        self.states = list(mdp.get_states())
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        actions = [list(mdp.get_actions(state)) for state in self.states]
+        self.num_actions = max([len(state_actions) for state_actions in actions] + [1])
+
+        rows, cols, probs = [], [], []
+        s = 0
+        # New states can be discovered while iterating, so self.states may grow
+        while s < len(self.states):
+            if s == len(actions):
+                actions.append(list(mdp.get_actions(self.states[s])))
+                assert len(actions[s]) <= self.num_actions
+            for a, action in enumerate(actions[s]):
+                for next_state, prob in mdp.get_transition_states_and_probs(self.states[s], action):
+                    if next_state not in self.state_index:
+                        self.state_index[next_state] = len(self.states)
+                        self.states.append(next_state)
+                    rows.append(s * self.num_actions + a)
+                    cols.append(self.state_index[next_state])
+                    probs.append(prob)
+            s += 1
+        self.num_states = len(self.states)
+
+        self.action_mask = np.zeros([self.num_states, self.num_actions], dtype=np.float32)
+        for s, state_actions in enumerate(actions):
+            self.action_mask[s, :len(state_actions)] = 1
+        # Duplicate (row, next state) entries are summed, and the next states of each row are sorted
+        self.transitions = csr_matrix(
+            (np.array(probs, dtype=np.float32), (rows, cols)),
+            shape=(self.num_states * self.num_actions, self.num_states))
+        self.transitions.sum_duplicates()
+
+        feature_dim = len(mdp.get_features(mdp.get_start_state()))
+        self.features = np.zeros([self.num_states, feature_dim], dtype=np.float32)
+        for s, state in enumerate(self.states):
+            if not mdp.is_terminal(state):
+                self.features[s] = mdp.get_features(state)
+        self.start_index = self.state_index[mdp.get_start_state()]
+
+    def get_dense_transitions(self):
+        """Returns the transitions as a num_states x num_actions x num_states array."""
+        dense = self.transitions.toarray()
+        return dense.reshape([self.num_states, self.num_actions, self.num_states])
+
+    def get_sparse_transitions(self):
+        """Returns the transitions in coordinate format: an nnz x 2 array of (row, next state) indices sorted in
+        row-major order, the nnz probabilities and the dense shape."""
+        row_lengths = np.diff(self.transitions.indptr)
+        rows = np.repeat(np.arange(self.transitions.shape[0]), row_lengths)
+        indices = np.stack([rows, self.transitions.indices], axis=1).astype(np.int64)
+        return indices, self.transitions.data, np.array(self.transitions.shape, dtype=np.int64)
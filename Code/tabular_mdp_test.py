@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+from gridworld import Direction, GridworldMdp
+
+
+class TestTabularMdp(unittest.TestCase):
+    def setUp(self):
+        self.grid = ['XXXXX',
+                     'X  AX',
+                     'X X X',
+                     'X  1X',
+                     'XXXXX']
+        self.mdp = GridworldMdp(self.grid, None, noise=0.2)
+        self.mdp.start_state = (3, 1)
+        self.mdp.features = {(x, y): np.array([x, y]) for x, y in self.mdp.get_states()[:-1]}
+
+    def test_states_and_features(self):
+        tabular_mdp = self.mdp.convert_to_tabular_input()
+        self.assertEqual(tabular_mdp.states, self.mdp.get_states())
+        self.assertEqual(tabular_mdp.states[tabular_mdp.start_index], (3, 1))
+        for i, state in enumerate(tabular_mdp.states[:-1]):
+            self.assertEqual(list(tabular_mdp.features[i]), list(state))
+        # The terminal state has no features and no actions
+        self.assertEqual(list(tabular_mdp.features[-1]), [0, 0])
+        self.assertEqual(list(tabular_mdp.action_mask[-1]), [0, 0])
+        self.assertIs(self.mdp.convert_to_tabular_input(), tabular_mdp)
+
+    def test_transitions(self):
+        tabular_mdp = self.mdp.convert_to_tabular_input()
+        transitions = tabular_mdp.get_dense_transitions()
+        s = tabular_mdp.state_index[(2, 1)]
+        self.assertEqual(self.mdp.get_actions((2, 1)), [Direction.EAST, Direction.WEST])
+        self.assertEqual(list(tabular_mdp.action_mask[s]), [1, 1])
+        # Moving east slips north or south into walls with probability 0.2, staying in place
+        east = transitions[s, 0]
+        self.assertAlmostEqual(east[tabular_mdp.state_index[(3, 1)]], 0.8)
+        self.assertAlmostEqual(east[s], 0.2)
+        np.testing.assert_allclose(transitions.sum(axis=-1), tabular_mdp.action_mask, rtol=1e-6)
+
+        indices, probs, shape = tabular_mdp.get_sparse_transitions()
+        self.assertEqual(list(shape), [tabular_mdp.num_states * tabular_mdp.num_actions, tabular_mdp.num_states])
+        dense = np.zeros(shape)
+        dense[indices[:, 0], indices[:, 1]] = probs
+        self.assertTrue(np.array_equal(dense.reshape(transitions.shape), transitions))
+
+
+if __name__ == '__main__':
+    unittest.main()